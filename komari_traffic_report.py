@@ -11,11 +11,18 @@ import time
 import traceback
 import socket
 import gzip
+import bisect
+import heapq
+import functools
+import collections
+import queue
 import html
 import concurrent.futures
 import signal
 import secrets
 import threading
+import http.server
+import atexit
 from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import datetime, timedelta, date, timezone
@@ -27,6 +34,11 @@ import sqlite3
 from requests.adapters import HTTPAdapter
 from urllib3.util import Retry
 
+try:
+    import orjson
+except ImportError:  # 可选加速依赖：未安装时回退到标准库 json
+    orjson = None
+
 if sys.platform == "win32":
     import msvcrt
 else:
@@ -161,6 +173,16 @@ KOMARI_API_TOKEN = os.environ.get("KOMARI_API_TOKEN", "")
 KOMARI_API_TOKEN_HEADER = os.environ.get("KOMARI_API_TOKEN_HEADER", "Authorization")
 KOMARI_API_TOKEN_PREFIX = os.environ.get("KOMARI_API_TOKEN_PREFIX", "Bearer")
 KOMARI_FETCH_WORKERS = int(os.environ.get("KOMARI_FETCH_WORKERS", "6"))
+KOMARI_FETCH_ASYNC = parse_bool_env("KOMARI_FETCH_ASYNC", False)  # 需安装 aiohttp；节点多时用 asyncio 并发拉取
+KOMARI_FETCH_ASYNC_LIMIT = 128
+
+# asyncio/aiohttp 只有异步拉取路径用到，按需导入，避免 health/config-validate 等短命令付出导入开销
+aiohttp = None
+if KOMARI_FETCH_ASYNC:
+    try:
+        import aiohttp
+    except ImportError:  # 可选依赖：未安装时回退到线程池
+        aiohttp = None
 
 TOP_N = int(os.environ.get("TOP_N", "3"))  # 默认 Top3（日报/周报/月报/Top命令都用它）
 
@@ -171,10 +193,12 @@ AI_MODEL = os.environ.get("AI_MODEL", "").strip()
 # /top Nh 与当前周期统计依赖连续采样：bot 运行时自动采样
 SAMPLE_INTERVAL_SECONDS = int(os.environ.get("SAMPLE_INTERVAL_SECONDS", "300"))  # 默认 5 分钟
 SAMPLE_RETENTION_HOURS = int(os.environ.get("SAMPLE_RETENTION_HOURS", "2"))    # 默认保留 2 小时采样
+SAMPLE_FLUSH_SECONDS = max(0, int(os.environ.get("SAMPLE_FLUSH_SECONDS", "60")))  # samples.jsonl 合并落盘间隔
+SAMPLES_COMPACT_INTERVAL_SECONDS = 86400  # samples.jsonl 每天最多压缩一次
 TRAFFIC_SNAPSHOT_RETENTION_DAYS = max(1, int(os.environ.get("TRAFFIC_SNAPSHOT_RETENTION_DAYS", "45")))
 
 HISTORY_PATH = os.path.join(DATA_DIR, "history.json")
-SAMPLES_PATH = os.path.join(DATA_DIR, "samples.json")
+SAMPLES_PATH = os.path.join(DATA_DIR, "samples.jsonl")
 TG_OFFSET_PATH = os.path.join(DATA_DIR, "tg_offset.txt")
 TG_CONFIRM_PATH = os.path.join(DATA_DIR, "tg_confirm.json")
 AI_PACK_CACHE_PATH = os.path.join(DATA_DIR, "ai_pack_cache.json")
@@ -184,6 +208,19 @@ TRAFFIC_DB_PATH = os.path.join(DATA_DIR, "traffic.db")
 
 TIMEOUT = int(os.environ.get("KOMARI_TIMEOUT_SECONDS", "15"))  # Komari API timeout（秒）
 
+# Telegram 限制约 30 条/秒（全局）与 20 条/分钟（群组），留出余量
+TG_GLOBAL_PER_SECOND = 25
+TG_CHAT_PER_MINUTE = 18
+TG_RATE_LIMIT_RETRIES = 2
+TG_MESSAGE_LIMIT = 4096  # sendMessage 单条文本上限（字符）
+TG_SEND_COALESCE_SECONDS = 0.3  # 发送线程合并同一 chat 消息的等待窗口
+# getUpdates 长轮询服务端等待秒数；HTTP 读超时再多留 5 秒。
+# 不宜过长：中间 NAT/代理常在 30s 左右回收空闲连接，退出时也要等当前轮询返回。
+TG_POLL_TIMEOUT = 25
+# tg_offset.txt 合并落盘间隔：Telegram 以下一次 getUpdates 的 offset 确认 update，
+# 文件只在重启时用到，运行中无需每批都写
+TG_OFFSET_FLUSH_SECONDS = 5
+
 APP_VERSION = os.environ.get("APP_VERSION", "dev").strip() or "dev"
 GIT_COMMIT = os.environ.get("GIT_COMMIT", "").strip()
 BUILD_DATE = os.environ.get("BUILD_DATE", "").strip()
@@ -196,6 +233,13 @@ LOG_FILE = os.environ.get("LOG_FILE", "").strip()
 
 BOT_INSTANCE_NAME = os.environ.get("BOT_INSTANCE_NAME", "").strip()
 BOT_START_NOTIFY = parse_bool_env("BOT_START_NOTIFY", True)
+
+# webhook 模式（python komari_traffic_report.py webhook）：Telegram 主动推送 update，替代 getUpdates 轮询
+TELEGRAM_WEBHOOK_URL = os.environ.get("TELEGRAM_WEBHOOK_URL", "").strip()  # 公网 HTTPS 地址，反代到下面的端口
+TELEGRAM_WEBHOOK_SECRET = os.environ.get("TELEGRAM_WEBHOOK_SECRET", "").strip()
+TELEGRAM_WEBHOOK_HOST = os.environ.get("TELEGRAM_WEBHOOK_HOST", "0.0.0.0").strip() or "0.0.0.0"
+TELEGRAM_WEBHOOK_PORT = int(os.environ.get("TELEGRAM_WEBHOOK_PORT", "8443"))
+TELEGRAM_WEBHOOK_MAX_BODY = 1024 * 1024
 AI_PACK_CACHE_TTL_SECONDS = max(0, int(os.environ.get("AI_PACK_CACHE_TTL_SECONDS", "3600")))
 
 ALERTS_ENABLED = parse_bool_env("ALERTS_ENABLED", True)
@@ -210,21 +254,34 @@ ALERT_DAILY_TOTAL_BYTES = parse_bytes_env("ALERT_DAILY_TOTAL_BYTES")
 ALERT_DAILY_NODE_BYTES = parse_bytes_env("ALERT_DAILY_NODE_BYTES")
 ALERT_RECOVERY_NOTIFY = parse_bool_env("ALERT_RECOVERY_NOTIFY", True)
 
-SHUTTING_DOWN = False
+SHUTDOWN_EVENT = threading.Event()  # SIGTERM/SIGINT 置位，各主循环据此收尾退出
 SAMPLE_THREAD: threading.Thread | None = None
 SAMPLE_STOP_EVENT = threading.Event()
 SCHEDULER_THREAD: threading.Thread | None = None
 SCHEDULER_STOP_EVENT = threading.Event()
+TG_SEND_THREAD: threading.Thread | None = None
 
 _TRAFFIC_DB_INITIALIZED = False
 _SAMPLES_MIGRATED = False
+_JSON_CACHE: dict[str, tuple[int, int, object]] = {}
+_SAMPLES_LOCK = threading.RLock()
+_SAMPLES_STATE = {"path": "", "sig": None, "samples": [], "ts": [], "pending": [], "flushed_at": None, "compacted_at": None}
 
 
 def ai_enabled() -> bool:
     return bool(AI_API_BASE and AI_API_KEY and AI_MODEL)
 
 
-def build_http_session() -> requests.Session:
+def build_komari_headers() -> dict:
+    headers = {"Accept": "application/json"}
+    if KOMARI_API_TOKEN:
+        prefix = KOMARI_API_TOKEN_PREFIX.strip()
+        value = f"{prefix} {KOMARI_API_TOKEN}".strip()
+        headers[KOMARI_API_TOKEN_HEADER] = value
+    return headers
+
+
+def mount_http_adapters(session: requests.Session, pool_size: int = 10) -> requests.Session:
     retry = Retry(
         total=3,
         connect=3,
@@ -234,14 +291,67 @@ def build_http_session() -> requests.Session:
         status_forcelist=(429, 500, 502, 503, 504),
         allowed_methods=frozenset(["GET"]),
     )
-    adapter = HTTPAdapter(max_retries=retry)
-    session = requests.Session()
+    # 连接池不小于并发数，避免 fetch 线程排队等连接
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     return session
 
 
-HTTP_SESSION = build_http_session()
+def build_http_session(pool_size: int = 10) -> requests.Session:
+    session = mount_http_adapters(requests.Session(), pool_size)
+    # Komari 鉴权头在进程内不变，挂在 session 上，避免每个请求重新构造与合并
+    session.headers.update(_KOMARI_HEADERS)
+    return session
+
+
+_KOMARI_HEADERS = build_komari_headers()
+_HTTP_POOL_SIZE = max(10, KOMARI_FETCH_WORKERS * 2)
+HTTP_SESSION = build_http_session(_HTTP_POOL_SIZE)
+_FETCH_POOL: concurrent.futures.ThreadPoolExecutor | None = None
+_FETCH_POOL_WORKERS = 0
+_FETCH_POOL_LOCK = threading.Lock()
+_AIOHTTP_MISSING_WARNED = False
+_ARCHIVE_POOL: concurrent.futures.ThreadPoolExecutor | None = None
+_ARCHIVE_POOL_LOCK = threading.Lock()
+_POST_SESSIONS: dict[int, requests.Session] = {}
+_POST_SESSIONS_LOCK = threading.Lock()
+_TG_RATE_LOCK = threading.Lock()
+_TG_SENT_GLOBAL: collections.deque = collections.deque()
+_TG_SENT_BY_CHAT: dict[str, collections.deque] = {}
+_TG_REPLY_BATCH = threading.local()
+_TG_OFFSET_STATE = {"pending": None, "saved": None, "flushed_at": None}
+_TG_SEND_QUEUE: queue.Queue = queue.Queue(maxsize=1024)
+_LOG_THROTTLE: dict[str, float] = {}
+
+
+def fetch_pool() -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Komari 节点并发拉取共用的常驻线程池；KOMARI_FETCH_WORKERS 被运行时配置修改后自动重建。
+    """
+    global _FETCH_POOL, _FETCH_POOL_WORKERS, _HTTP_POOL_SIZE
+    workers = max(1, KOMARI_FETCH_WORKERS)
+    with _FETCH_POOL_LOCK:
+        if _FETCH_POOL is None or _FETCH_POOL_WORKERS != workers:
+            # 旧池不主动 shutdown：其他线程可能刚拿到它还在 submit，丢掉引用后空闲线程会随池回收退出
+            if workers * 2 > _HTTP_POOL_SIZE:
+                _HTTP_POOL_SIZE = workers * 2
+                mount_http_adapters(HTTP_SESSION, _HTTP_POOL_SIZE)
+            _FETCH_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="komari-fetch")
+            _FETCH_POOL_WORKERS = workers
+        return _FETCH_POOL
+
+
+def shutdown_fetch_pool():
+    global _FETCH_POOL, _FETCH_POOL_WORKERS
+    with _FETCH_POOL_LOCK:
+        if _FETCH_POOL is not None:
+            _FETCH_POOL.shutdown(wait=False, cancel_futures=True)
+        _FETCH_POOL = None
+        _FETCH_POOL_WORKERS = 0
+
+
+atexit.register(shutdown_fetch_pool)
 
 
 def setup_logging():
@@ -255,15 +365,6 @@ def setup_logging():
     )
 
 
-def build_komari_headers() -> dict:
-    headers = {"Accept": "application/json"}
-    if KOMARI_API_TOKEN:
-        prefix = KOMARI_API_TOKEN_PREFIX.strip()
-        value = f"{prefix} {KOMARI_API_TOKEN}".strip()
-        headers[KOMARI_API_TOKEN_HEADER] = value
-    return headers
-
-
 def _require_positive_int(name: str, value: int):
     if value <= 0:
         raise RuntimeError(f"{name} must be > 0")
@@ -302,9 +403,7 @@ def validate_config_or_raise():
     parse_silence_windows(ALERT_SILENCE_WINDOWS)
 
 
-def run_healthcheck_or_raise():
-    ensure_dirs()
-
+def _health_check_storage():
     test_path = os.path.join(DATA_DIR, ".health_write_test")
     try:
         with open(test_path, "w", encoding="utf-8") as f:
@@ -318,25 +417,43 @@ def run_healthcheck_or_raise():
             try:
                 if p == TG_OFFSET_PATH:
                     _ = load_offset()
+                elif p == SAMPLES_PATH:
+                    for _ in iter_jsonl(p, strict=True):
+                        pass
                 else:
                     load_json_strict(p)
             except Exception as e:
                 raise RuntimeError(f"Corrupted file: {p}: {e}")
 
+
+def _health_check_sqlite():
     try:
         traffic_db_healthcheck()
     except Exception as e:
         raise RuntimeError(f"SQLite healthcheck failed: {e}")
 
+
+def _health_check_komari():
     try:
-        HTTP_SESSION.get(KOMARI_BASE_URL, timeout=TIMEOUT, headers=build_komari_headers())
+        HTTP_SESSION.get(KOMARI_BASE_URL, timeout=TIMEOUT)
     except Exception as e:
         raise RuntimeError(f"Komari unreachable: {e}")
 
 
+def run_healthcheck_or_raise():
+    ensure_dirs()
+
+    # 三项探测互不依赖，并发执行：耗时取决于最慢的一项（通常是 Komari 请求）而不是三者之和
+    probes = (_health_check_storage, _health_check_sqlite, _health_check_komari)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(probes), thread_name_prefix="health") as pool:
+        futures = [pool.submit(probe) for probe in probes]
+    # 按固定顺序抛出第一个失败，错误信息与串行执行时一致
+    for future in futures:
+        future.result()
+
+
 def _handle_sigterm(signum, _frame):
-    global SHUTTING_DOWN
-    SHUTTING_DOWN = True
+    SHUTDOWN_EVENT.set()
     logging.warning("received signal %s, shutting down gracefully...", signum)
 
 
@@ -350,13 +467,17 @@ def ensure_dirs():
         pass
 
 
+_BYTE_UNITS = ("B", "KiB", "MiB", "GiB", "TiB", "PiB")
+
+
+@functools.lru_cache(maxsize=256)
 def human_bytes(n: int) -> str:
-    units = ["B", "KiB", "MiB", "GiB", "TiB", "PiB"]
-    x = float(max(int(n), 0))
-    for idx, u in enumerate(units):
-        if x < 1024 or idx == len(units) - 1:
-            return f"{x:.2f} {u}" if u != "B" else f"{int(x)} B"
-        x /= 1024
+    n = max(int(n), 0)
+    if n < 1024:
+        return f"{n} B"
+    # 每 10 个二进制位进一级单位，bit_length 直接得到单位下标
+    idx = min(len(_BYTE_UNITS) - 1, (n.bit_length() - 1) // 10)
+    return f"{float(n) / (1 << (idx * 10)):.2f} {_BYTE_UNITS[idx]}"
 
 
 def telegram_html_escape(value) -> str:
@@ -384,13 +505,58 @@ def start_of_month(d: date) -> date:
 
 
 def yyyymm(d: date) -> str:
-    return f"{d.year:04d}-{d.month:02d}"
+    return _yyyymm(d.year, d.month)
+
+
+@functools.lru_cache(maxsize=1)
+def _yyyymm(year: int, month: int) -> str:
+    # 单槽缓存：连续按天遍历同一个月时只格式化一次
+    return f"{year:04d}-{month:02d}"
+
+
+def is_iso_day_key(value) -> bool:
+    # 仅接受 YYYY-MM-DD；3.11 的 fromisoformat 还接受 20260601、2026-W23-1 等写法，需先校验形状
+    if not isinstance(value, str) or len(value) != 10 or value[4] != "-" or value[7] != "-":
+        return False
+    digits = value[:4] + value[5:7] + value[8:]
+    if not (digits.isascii() and digits.isdigit()):
+        return False
+    try:
+        date.fromisoformat(value)
+    except ValueError:
+        return False
+    return True
+
+
+# 无 orjson 时复用同一个紧凑编码器，避免每次 json.dumps(..., 非默认参数) 重新构造 JSONEncoder
+_JSON_COMPACT_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+def json_loads_bytes(raw: bytes | str):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def json_dumps_bytes(data, indent: bool = False) -> bytes:
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(data, option=option)
+    if indent:
+        return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+    return _JSON_COMPACT_ENCODER.encode(data).encode("utf-8")
+
+
+def json_dumps_text(data) -> str:
+    return json_dumps_bytes(data).decode("utf-8")
 
 
 def load_json(path: str, default):
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(path, "rb") as f:
+            return json_loads_bytes(f.read())
     except FileNotFoundError:
         return default
     except Exception as e:
@@ -407,12 +573,41 @@ def load_json(path: str, default):
         return default
 
 
+def load_json_cached(path: str, default):
+    """
+    只读热路径使用：按 (mtime_ns, size) 复用上次解析结果，文件未变化时只需一次 stat。
+    返回值与缓存共享，调用方不得原地修改。
+    """
+    path = str(path)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        _JSON_CACHE.pop(path, None)
+        return default
+    except OSError:
+        return load_json(path, default)
+    cached = _JSON_CACHE.get(path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    data = load_json(path, default)
+    if data is not default:
+        _JSON_CACHE[path] = (st.st_mtime_ns, st.st_size, data)
+    return data
+
+
+def _invalidate_json_cache(path: str):
+    _JSON_CACHE.pop(str(path), None)
+
+
 def load_json_strict(path: str):
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open(path, "rb") as f:
+        return json_loads_bytes(f.read())
 
 
 def parse_date_yyyy_mm_dd(value: str) -> date:
+    if is_iso_day_key(value):
+        return date.fromisoformat(value)
+    # 其余写法（如 2026-6-1）仍交给 strptime，与原先的接受范围保持一致
     return datetime.strptime(value, "%Y-%m-%d").date()
 
 
@@ -421,33 +616,32 @@ def unique_temp_path(path: str) -> str:
     return f"{path}.{os.getpid()}.{threading.get_ident()}.{secrets.token_urlsafe(6)}.tmp"
 
 
-def save_json_atomic(path: str, data):
-    path = str(path)
-    parent_dir = os.path.dirname(path) or "."
-    tmp = os.path.join(parent_dir, f".tmp.{os.path.basename(path)}.{os.getpid()}.{int(time.time()*1000)}")
-    try:
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-            f.flush()
-            os.fsync(f.fileno())
-        os.replace(tmp, path)
-    finally:
-        try:
-            if os.path.exists(tmp):
-                os.unlink(tmp)
-        except OSError:
-            pass
+def fsync_data(fd: int):
+    # rename 前只需保证数据落盘；fdatasync 省去一次 inode 元数据刷写，不支持的平台回退到 fsync
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
 
 
-def save_text_atomic(path: str, text: str):
+def _replace_file_atomic(path: str, payload: bytes, durable: bool = True):
+    """
+    写临时文件后 os.replace：读者永远看不到半个文件。
+    直接 os.open/os.write 写整块 payload，不经过 Python 文件对象的缓冲层。
+    durable=False 时跳过 fsync，用于丢了也无妨的状态文件（采样缓存、告警节流）。
+    """
     path = str(path)
-    parent_dir = os.path.dirname(path) or "."
-    tmp = os.path.join(parent_dir, f".tmp.{os.path.basename(path)}.{os.getpid()}.{int(time.time()*1000)}")
+    tmp = unique_temp_path(path)
     try:
-        with open(tmp, "w", encoding="utf-8") as f:
-            f.write(str(text))
-            f.flush()
-            os.fsync(f.fileno())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o666)
+        try:
+            view = memoryview(payload)
+            while view:
+                view = view[os.write(fd, view):]
+            if durable:
+                fsync_data(fd)
+        finally:
+            os.close(fd)
         os.replace(tmp, path)
     finally:
         try:
@@ -457,6 +651,54 @@ def save_text_atomic(path: str, text: str):
             pass
 
 
+def save_json_atomic(path: str, data):
+    _replace_file_atomic(path, json_dumps_bytes(data, indent=True))
+    _invalidate_json_cache(path)
+
+
+def save_json_best_effort(path: str, data):
+    _replace_file_atomic(path, json_dumps_bytes(data), durable=False)
+    _invalidate_json_cache(path)
+
+
+def save_text_atomic(path: str, text: str, durable: bool = True):
+    _replace_file_atomic(path, str(text).encode("utf-8"), durable=durable)
+
+
+def iter_jsonl(path: str, strict: bool = False):
+    """
+    逐行读取 JSON Lines；非严格模式下跳过损坏的行（如异常退出时写了一半的末行）。
+    """
+    with open(path, "rb") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json_loads_bytes(line)
+            except ValueError:
+                if strict:
+                    raise ValueError(f"invalid JSON at line {lineno}")
+                logging.warning("skip invalid JSON line %s in %s", lineno, path)
+
+
+def append_jsonl(path: str, rows: list):
+    if not rows:
+        return
+    payload = b"".join(json_dumps_bytes(row) + b"\n" for row in rows)
+    with open(path, "a+b") as f:
+        # 上次异常退出可能留下没有换行的半行，先补换行避免与新行粘连
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                payload = b"\n" + payload
+        f.write(payload)
+
+
+def save_jsonl_atomic(path: str, rows: list, durable: bool = True):
+    _replace_file_atomic(path, b"".join(json_dumps_bytes(row) + b"\n" for row in rows), durable=durable)
+
+
 def runtime_config_path() -> str:
     return os.path.join(DATA_DIR, "runtime_config.json")
 
@@ -781,14 +1023,14 @@ def init_traffic_db():
 
 def _json_dumps_compact(data) -> str:
     try:
-        return json.dumps(data if data is not None else {}, ensure_ascii=False, separators=(",", ":"))
+        return json_dumps_text(data if data is not None else {})
     except TypeError:
-        return json.dumps({"value": str(data)}, ensure_ascii=False, separators=(",", ":"))
+        return json_dumps_text({"value": str(data)})
 
 
 def _json_loads_object(text: str) -> dict:
     try:
-        value = json.loads(text or "{}")
+        value = json_loads_bytes(text or "{}")
         return value if isinstance(value, dict) else {"value": value}
     except Exception:
         return {}
@@ -1065,7 +1307,7 @@ def traffic_db_maintenance_status(retention_days: int | None = None, now_ts: int
     size = os.path.getsize(TRAFFIC_DB_PATH) if os.path.exists(TRAFFIC_DB_PATH) else 0
     counts = traffic_db_table_counts()
     daily_days = NODE_DAILY_USAGE_RETENTION_DAYS
-    daily_cutoff = (datetime.fromtimestamp(now_value, TZ).date() - timedelta(days=daily_days)).strftime("%Y-%m-%d") if daily_days else ""
+    daily_cutoff = (datetime.fromtimestamp(now_value, TZ).date() - timedelta(days=daily_days)).isoformat() if daily_days else ""
     segment_cutoff = now_value - TRAFFIC_SNAPSHOT_RETENTION_DAYS * 86400
     period_rollups = period_rollups_table_status()
     with traffic_db_session() as conn:
@@ -1163,7 +1405,7 @@ def save_traffic_snapshot(ts: int | float, nodes_map: dict, skipped: list[str] |
         return
     init_traffic_db()
     ts_int = int(ts)
-    skipped_json = json.dumps([str(item) for item in (skipped or [])], ensure_ascii=False)
+    skipped_json = json_dumps_text([str(item) for item in (skipped or [])])
     rows = []
     for uuid, item in nodes_map.items():
         if not isinstance(item, dict):
@@ -1359,7 +1601,7 @@ def traffic_sample_lag_status(now_ts: int | float | None = None) -> dict:
 
 def _json_loads_list(text: str) -> list:
     try:
-        value = json.loads(text or "[]")
+        value = json_loads_bytes(text or "[]")
         return value if isinstance(value, list) else []
     except Exception:
         return []
@@ -1434,8 +1676,8 @@ def save_traffic_segments(segments: list[dict]) -> int:
         end = int(segment.get("sample_to_ts", 0) or 0)
         if end <= start:
             continue
-        skipped_json = json.dumps(list(dict.fromkeys(str(item) for item in (segment.get("skipped", []) or []))), ensure_ascii=False)
-        reset_json = json.dumps(list(dict.fromkeys(str(item) for item in (segment.get("reset_warnings", []) or []))), ensure_ascii=False)
+        skipped_json = json_dumps_text(list(dict.fromkeys(str(item) for item in (segment.get("skipped", []) or []))))
+        reset_json = json_dumps_text(list(dict.fromkeys(str(item) for item in (segment.get("reset_warnings", []) or []))))
         for uuid, item in (segment.get("nodes") or {}).items():
             if not isinstance(item, dict):
                 continue
@@ -1584,8 +1826,8 @@ def _traffic_segment_usage(from_ts: int | float, to_ts: int | float) -> dict:
         day
         for row in rows
         for day in (
-            datetime.fromtimestamp(int(row.get("sample_from_ts", 0) or 0), TZ).strftime("%Y-%m-%d"),
-            datetime.fromtimestamp(max(int(row.get("sample_to_ts", 0) or 0) - 1, int(row.get("sample_from_ts", 0) or 0)), TZ).strftime("%Y-%m-%d"),
+            datetime.fromtimestamp(int(row.get("sample_from_ts", 0) or 0), TZ).date().isoformat(),
+            datetime.fromtimestamp(max(int(row.get("sample_to_ts", 0) or 0) - 1, int(row.get("sample_from_ts", 0) or 0)), TZ).date().isoformat(),
         )
         if int(row.get("sample_from_ts", 0) or 0) > 0 and int(row.get("sample_to_ts", 0) or 0) > 0
     })
@@ -1703,7 +1945,7 @@ def materialize_daily_usage_from_segments(days: list[date]) -> int:
         if not nodes:
             continue
         upsert_daily_usage(
-            day.strftime("%Y-%m-%d"),
+            day.isoformat(),
             nodes,
             source="traffic_segments",
             source_from=str(int(usage.get("sample_from_ts", 0) or 0)),
@@ -1823,7 +2065,7 @@ def materialize_latest_traffic_segment(current_ts: int | float | None = None) ->
         "segments": len(segments),
         "saved_rows": saved,
         "daily_rows": daily_rows,
-        "days": sorted({d.strftime("%Y-%m-%d") for d in days}),
+        "days": sorted({d.isoformat() for d in days}),
     }
 
 
@@ -1936,7 +2178,7 @@ def query_usage(from_ts: int | float, to_ts: int | float, group_by: str = "node"
                 sample_from_ts = min([ts for ts in (sample_from_ts, day_sample_from) if ts] or [0])
             sample_to_ts = max(sample_to_ts, day_sample_to)
             sample_days.update(str(item) for item in (day_usage.get("sample_days", []) or []))
-            covered_days.append(d.strftime("%Y-%m-%d"))
+            covered_days.append(d.isoformat())
         else:
             # 该天用 rollup
             rollup = aggregate_daily_usage(d, d)
@@ -1944,7 +2186,7 @@ def query_usage(from_ts: int | float, to_ts: int | float, group_by: str = "node"
                 for uuid, item in rollup.items():
                     _add_usage_to_node_map(total_nodes, str(uuid), str(item.get("name") or uuid), int(item.get("up", 0) or 0), int(item.get("down", 0) or 0))
                 source_parts.append("node_daily_usage")
-                covered_days.append(d.strftime("%Y-%m-%d"))
+                covered_days.append(d.isoformat())
 
         d += timedelta(days=1)
 
@@ -2012,8 +2254,8 @@ def upsert_daily_usage(day_str: str, deltas: dict, source: str = "history", sour
         return
     init_traffic_db()
     updated_at = int(time.time())
-    reset_json = json.dumps(reset_warnings or [], ensure_ascii=False)
-    skipped_json = json.dumps(skipped or [], ensure_ascii=False)
+    reset_json = json_dumps_text(reset_warnings or [])
+    skipped_json = json_dumps_text(skipped or [])
     rows = []
     for uuid, item in deltas.items():
         up = max(0, int(item.get("up", 0) or 0))
@@ -2076,7 +2318,7 @@ def prune_node_daily_usage(retention_days: int | None = None, today_value: date
             "remaining": int(row["c"] or 0),
         }
     cutoff_day = (today_value or today_date()) - timedelta(days=days)
-    cutoff_text = cutoff_day.strftime("%Y-%m-%d")
+    cutoff_text = cutoff_day.isoformat()
     with traffic_db_session() as conn:
         cur = conn.execute("DELETE FROM node_daily_usage WHERE day < ?", (cutoff_text,))
         deleted = int(cur.rowcount or 0)
@@ -2092,8 +2334,8 @@ def prune_node_daily_usage(retention_days: int | None = None, today_value: date
 
 def aggregate_daily_usage(from_day: date, to_day: date) -> dict:
     init_traffic_db()
-    start = from_day.strftime("%Y-%m-%d")
-    end = to_day.strftime("%Y-%m-%d")
+    start = from_day.isoformat()
+    end = to_day.isoformat()
     with traffic_db_session() as conn:
         rows = conn.execute(
             """
@@ -2152,10 +2394,10 @@ def _traffic_group_key(day_value: date, group: str) -> tuple[str, str]:
     if group == "weekly":
         start = start_of_week(day_value)
         end = start + timedelta(days=6)
-        return start.strftime("%Y-%m-%d"), f"{start.strftime('%Y-%m-%d')} → {end.strftime('%Y-%m-%d')}"
+        return start.isoformat(), f"{start.isoformat()} → {end.isoformat()}"
     if group == "monthly":
         return yyyymm(day_value), yyyymm(day_value)
-    return day_value.strftime("%Y-%m-%d"), day_value.strftime("%Y-%m-%d")
+    return day_value.isoformat(), day_value.isoformat()
 
 
 def _source_label_from_parts(parts: list[str]) -> str:
@@ -2200,7 +2442,7 @@ def build_daily_period_usage(from_dt: datetime, to_dt: datetime | None = None) -
     last_day = to_dt.date()
     d = from_dt.date()
     while d <= last_day:
-        day_text = d.strftime("%Y-%m-%d")
+        day_text = d.isoformat()
         day_start = start_of_day(d)
         day_end = start_of_day(d + timedelta(days=1))
         window_start = max(day_start, from_dt)
@@ -2312,8 +2554,8 @@ def traffic_range_summary(from_day: date, to_day: date, group: str = "daily") ->
         })
 
     return {
-        "from": from_day.strftime("%Y-%m-%d"),
-        "to": to_day.strftime("%Y-%m-%d"),
+        "from": from_day.isoformat(),
+        "to": to_day.isoformat(),
         "group": group,
         "days": period.get("days", []),
         "coverage_days": period.get("coverage_days", []),
@@ -2338,7 +2580,7 @@ def traffic_range_summary(from_day: date, to_day: date, group: str = "daily") ->
 
 def migrate_history_to_traffic_db():
     init_traffic_db()
-    hot = load_json(HISTORY_PATH, {"days": {}}).get("days", {})
+    hot = load_json_cached(HISTORY_PATH, {"days": {}}).get("days", {})
     for day_str, deltas in (hot or {}).items():
         if isinstance(deltas, dict):
             try:
@@ -2499,9 +2741,9 @@ def schedule_next_run_at(item: dict, now: datetime | None = None, horizon_days:
 
 def get_json(url: str):
     try:
-        r = HTTP_SESSION.get(url, timeout=TIMEOUT, headers=build_komari_headers())
+        r = HTTP_SESSION.get(url, timeout=TIMEOUT)
         r.raise_for_status()
-        return r.json()
+        return json_loads_bytes(r.content)
     except requests.exceptions.Timeout:
         logging.warning("get_json timeout: %s", url)
         raise
@@ -2510,21 +2752,49 @@ def get_json(url: str):
         raise
 
 
-def post_json(url: str, payload: dict, retries: int = 3):
+def build_post_session(retries: int = 3) -> requests.Session:
+    # 429 不在这里重试：由 telegram_send_to_chat 按 Telegram 返回的 retry_after 精确等待
     retry_strategy = Retry(
         total=retries,
         backoff_factor=1,
-        status_forcelist=[429, 500, 502, 503, 504],
+        status_forcelist=[500, 502, 503, 504],
         allowed_methods=["POST"],
         respect_retry_after_header=True,
     )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry_strategy)
     session = requests.Session()
     session.mount("https://", adapter)
     session.mount("http://", adapter)
-    r = session.post(url, json=payload, timeout=TIMEOUT)
+    return session
+
+
+def post_session(retries: int = 3) -> requests.Session:
+    """
+    Telegram 等外部请求复用的 keep-alive session（与带 Komari 鉴权头的 HTTP_SESSION 分开），按重试次数区分。
+    """
+    with _POST_SESSIONS_LOCK:
+        session = _POST_SESSIONS.get(retries)
+        if session is None:
+            session = _POST_SESSIONS[retries] = build_post_session(retries)
+        return session
+
+
+def telegram_poll_session() -> requests.Session:
+    """
+    getUpdates 长轮询复用的 keep-alive session；get_updates 自带重试退避，这里不再叠加 urllib3 重试。
+    """
+    return post_session(0)
+
+
+def post_json(url: str, payload: dict, retries: int = 3):
+    r = post_session(retries).post(
+        url,
+        data=json_dumps_bytes(payload),
+        headers={"Content-Type": "application/json"},
+        timeout=TIMEOUT,
+    )
     r.raise_for_status()
-    return r.json()
+    return json_loads_bytes(r.content)
 
 
 def telegram_send_to_chat(text: str, chat_id: str, parse_mode: str | None = "HTML"):
@@ -2538,9 +2808,203 @@ def telegram_send_to_chat(text: str, chat_id: str, parse_mode: str | None = "HTM
         "text": text,
         "disable_web_page_preview": True,
     }
+    if parse_mode == "HTML":
+        pending = getattr(_TG_REPLY_BATCH, "pending", None)
+        if pending is not None:
+            pending.setdefault(payload["chat_id"], []).append(text)
+            return None
     if parse_mode:
         payload["parse_mode"] = parse_mode
-    return post_json(url, payload)
+    for attempt in range(TG_RATE_LIMIT_RETRIES + 1):
+        telegram_rate_wait(payload["chat_id"])
+        try:
+            return post_json(url, payload)
+        except requests.exceptions.HTTPError as e:
+            retry_after = telegram_retry_after(e.response)
+            if retry_after is None or attempt >= TG_RATE_LIMIT_RETRIES:
+                raise
+            logging.warning("telegram rate limited, retry after %ss", retry_after)
+            time.sleep(retry_after)
+
+
+def telegram_rate_wait(chat_id: str):
+    """
+    发送前的滑动窗口限速：全局 TG_GLOBAL_PER_SECOND 条/秒、单个 chat TG_CHAT_PER_MINUTE 条/分钟。
+    """
+    while True:
+        with _TG_RATE_LOCK:
+            now = time.monotonic()
+            sent_all = _TG_SENT_GLOBAL
+            sent_chat = _TG_SENT_BY_CHAT.setdefault(str(chat_id), collections.deque())
+            while sent_all and sent_all[0] <= now - 1:
+                sent_all.popleft()
+            while sent_chat and sent_chat[0] <= now - 60:
+                sent_chat.popleft()
+            wait = 0.0
+            if len(sent_all) >= TG_GLOBAL_PER_SECOND:
+                wait = sent_all[0] + 1 - now
+            if len(sent_chat) >= TG_CHAT_PER_MINUTE:
+                wait = max(wait, sent_chat[0] + 60 - now)
+            if wait <= 0:
+                sent_all.append(now)
+                sent_chat.append(now)
+                return
+        time.sleep(wait)
+
+
+def telegram_retry_after(response) -> float | None:
+    """429 时返回 Telegram 要求的等待秒数（parameters.retry_after），否则 None。"""
+    if response is None or response.status_code != 429:
+        return None
+    try:
+        retry_after = json_loads_bytes(response.content).get("parameters", {}).get("retry_after")
+    except Exception:
+        retry_after = None
+    if retry_after is None:
+        retry_after = response.headers.get("Retry-After", 1)
+    try:
+        return min(max(float(retry_after), 0.0), 60.0)
+    except (TypeError, ValueError):
+        return 1.0
+
+
+def split_telegram_text(texts: list[str], limit: int | None = None) -> list[str]:
+    """
+    把多条消息用换行合并成尽量少的块，每块不超过 limit（默认 TG_MESSAGE_LIMIT）；
+    单条超长消息按行（必要时硬切）拆开。
+    """
+    limit = limit or TG_MESSAGE_LIMIT
+    pieces = []
+    for text in texts:
+        if len(text) <= limit:
+            pieces.append(text)
+            continue
+        for line in text.split("\n"):
+            while len(line) > limit:
+                pieces.append(line[:limit])
+                line = line[limit:]
+            pieces.append(line)
+
+    chunks = []
+    current = None
+    for piece in pieces:
+        if current is not None and len(current) + 1 + len(piece) <= limit:
+            current += "\n" + piece
+            continue
+        if current is not None:
+            chunks.append(current)
+        current = piece
+    if current is not None:
+        chunks.append(current)
+    return chunks
+
+
+@contextmanager
+def telegram_reply_batch():
+    """
+    一批 getUpdates 处理期间，当前线程的 HTML 回复先按 chat 累积；
+    结束时每个 chat 合并成尽量少的 sendMessage（单条 <= TG_MESSAGE_LIMIT）。
+    """
+    pending: dict[str, list[str]] = {}
+    _TG_REPLY_BATCH.pending = pending
+    try:
+        yield pending
+    finally:
+        _TG_REPLY_BATCH.pending = None
+        for chat_id, texts in pending.items():
+            for chunk in split_telegram_text(texts):
+                enqueue_telegram_reply(chat_id, chunk)
+
+
+def deliver_telegram_reply(chat_id: str, text: str):
+    try:
+        telegram_send_to_chat(text, chat_id, parse_mode="HTML")
+    except requests.exceptions.HTTPError as e:
+        # 合并/拆分后 HTML 可能不完整，退回纯文本发送
+        if e.response is None or e.response.status_code != 400:
+            raise
+        logging.warning("telegram html parse failed, fallback to plain text send")
+        telegram_send_to_chat(re.sub(r"</?[^>]+>", "", text), chat_id, parse_mode=None)
+
+
+def enqueue_telegram_reply(chat_id: str, text: str):
+    """
+    发送线程运行时放入队列立即返回，命令接收循环不被 Telegram 延迟/429 等待阻塞；
+    未启动或队列已满时同步发送。
+    """
+    if TG_SEND_THREAD and TG_SEND_THREAD.is_alive():
+        try:
+            _TG_SEND_QUEUE.put_nowait((chat_id, text))
+            return
+        except queue.Full:
+            logging.warning("telegram send queue full, sending inline")
+    deliver_telegram_reply(chat_id, text)
+
+
+def _flush_telegram_pending(pending: dict[str, list[str]], chat_id: str | None = None):
+    for cid in ([chat_id] if chat_id is not None else list(pending)):
+        for chunk in split_telegram_text(pending.pop(cid, [])):
+            try:
+                deliver_telegram_reply(cid, chunk)
+            except Exception as e:
+                # 命令回复在发送线程里失败（token 失效、被拉黑 403 等）时同 listen 循环一样限频告警
+                redacted_msg = redact_sensitive_data(str(e))
+                if should_alert("tg_reply", 300):
+                    alert_exception("telegram_send_worker", f"reply to {cid}", e)
+                    logging.error("telegram send failed: %s", redacted_msg)
+                else:
+                    logging.warning("telegram send failed: %s", redacted_msg)
+
+
+def telegram_send_worker_loop():
+    """
+    从队列取消息，同一 chat 在 TG_SEND_COALESCE_SECONDS 窗口内的消息合并成一条 sendMessage；
+    累积超过 TG_MESSAGE_LIMIT 时立即发送该 chat。
+    """
+    logging.info("telegram send worker started")
+    pending: dict[str, list[str]] = {}
+    pending_chars: dict[str, int] = {}
+    deadline = None
+    while True:
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            item = _TG_SEND_QUEUE.get(timeout=timeout)
+        except queue.Empty:
+            _flush_telegram_pending(pending)
+            pending_chars.clear()
+            deadline = None
+            continue
+        if item is None:
+            break
+
+        chat_id, text = item
+        pending.setdefault(chat_id, []).append(text)
+        pending_chars[chat_id] = pending_chars.get(chat_id, 0) + len(text) + 1
+        if pending_chars[chat_id] >= TG_MESSAGE_LIMIT:
+            _flush_telegram_pending(pending, chat_id)
+            pending_chars.pop(chat_id, None)
+        if not pending:
+            deadline = None
+        elif deadline is None:
+            deadline = time.monotonic() + TG_SEND_COALESCE_SECONDS
+
+    _flush_telegram_pending(pending)
+    logging.info("telegram send worker stopped")
+
+
+def start_telegram_sender():
+    global TG_SEND_THREAD
+    if TG_SEND_THREAD and TG_SEND_THREAD.is_alive():
+        return
+    TG_SEND_THREAD = threading.Thread(target=telegram_send_worker_loop, name="telegram-sender", daemon=True)
+    TG_SEND_THREAD.start()
+
+
+def stop_telegram_sender():
+    """退出前把队列里剩余的回复发完（最多等 10 秒）。"""
+    if TG_SEND_THREAD and TG_SEND_THREAD.is_alive():
+        _TG_SEND_QUEUE.put(None)
+        TG_SEND_THREAD.join(timeout=10)
 
 
 def telegram_send(text: str):
@@ -2622,7 +3086,7 @@ def ask_ai_with_data(question: str, data_pack: dict) -> str:
         return "⚠️ 数据获取异常，稍后再试。"
 
     try:
-        data_text = json.dumps(focused_pack, ensure_ascii=False)
+        data_text = json_dumps_text(focused_pack)
     except Exception:
         logging.exception("serialize data_pack error")
         data_text = str(focused_pack)
@@ -2739,10 +3203,24 @@ def should_alert(throttle_key: str, min_interval_seconds: int = 300) -> bool:
     last = int(state.get("last", 0))
     if now_ts - last < min_interval_seconds:
         return False
-    save_json_atomic(state_path, {"last": now_ts})
+    save_json_best_effort(state_path, {"last": now_ts})
     return True
 
 
+def log_exception_throttled(throttle_key: str, message: str, min_interval_seconds: int = 300):
+    """
+    在 except 块内调用：同一 key 每 min_interval_seconds 秒只输出一次完整 traceback，
+    其余降级为单行 warning，避免故障持续时每轮循环都格式化 traceback 刷屏。
+    """
+    now = time.monotonic()
+    last = _LOG_THROTTLE.get(throttle_key)
+    if last is None or now - last >= min_interval_seconds:
+        _LOG_THROTTLE[throttle_key] = now
+        logging.exception(message)
+        return
+    logging.warning("%s: %s", message, redact_sensitive_text(sys.exc_info()[1]))
+
+
 def alert_exception(where: str, cmd: str, exc: Exception):
     host = telegram_html_escape(redact_sensitive_text(socket.gethostname()))
     ts = now_dt().strftime("%Y-%m-%d %H:%M:%S %Z")
@@ -2777,6 +3255,7 @@ def fetch_nodes_and_totals():
     """
     返回：
       - out: list[NodeTotal]
+      - nodes_map: dict[uuid, {name, up, down}]  # 与 out 同一轮构建，供快照/采样直接使用
       - skipped: list[str]  # 被跳过的节点原因（timeout/empty/bad_resp/HTTPError等）
     """
     if not KOMARI_BASE_URL:
@@ -2788,6 +3267,7 @@ def fetch_nodes_and_totals():
 
     nodes = nodes_resp.get("data", [])
     out: list[NodeTotal] = []
+    nodes_map: dict[str, dict] = {}
     skipped: list[str] = []
 
     def fetch_one(node: dict):
@@ -2803,32 +3283,85 @@ def fetch_nodes_and_totals():
             return None, f"{name}({type(e).__name__})"
         except Exception as e:
             return None, f"{name}({type(e).__name__})"
+        return parse_recent_node_total(uuid, name, recent_resp)
 
-        if not (isinstance(recent_resp, dict) and recent_resp.get("status") == "success"):
-            return None, f"{name}(bad_resp)"
-
-        points = recent_resp.get("data", [])
-        if not points:
-            return None, f"{name}(empty)"
-
-        last = points[-1]
-        net = last.get("network", {}) if isinstance(last, dict) else {}
-        up = int(net.get("totalUp", 0))
-        down = int(net.get("totalDown", 0))
-        return NodeTotal(uuid=uuid, name=name, up=up, down=down), None
-
-    max_workers = max(1, min(len(nodes), KOMARI_FETCH_WORKERS))
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_map = {executor.submit(fetch_one, n): n for n in nodes}
-        for future in concurrent.futures.as_completed(future_map):
-            result, skip = future.result()
-            if skip:
-                skipped.append(skip)
-                continue
-            if result:
-                out.append(result)
+    if komari_async_fetch_available():
+        import asyncio
+        results = asyncio.run(fetch_recent_totals_async(nodes))
+    else:
+        executor = fetch_pool()
+        futures = [executor.submit(fetch_one, n) for n in nodes]
+        results = (future.result() for future in concurrent.futures.as_completed(futures))
+    for result, skip in results:
+        if skip:
+            skipped.append(skip)
+            continue
+        if result:
+            out.append(result)
+            nodes_map[result.uuid] = {"name": result.name, "up": result.up, "down": result.down}
+
+    return out, nodes_map, skipped
 
-    return out, skipped
+
+def parse_recent_node_total(uuid: str, name: str, recent_resp) -> tuple[NodeTotal | None, str | None]:
+    if not (isinstance(recent_resp, dict) and recent_resp.get("status") == "success"):
+        return None, f"{name}(bad_resp)"
+
+    points = recent_resp.get("data", [])
+    if not points:
+        return None, f"{name}(empty)"
+
+    last = points[-1]
+    net = last.get("network", {}) if isinstance(last, dict) else {}
+    up = int(net.get("totalUp", 0))
+    down = int(net.get("totalDown", 0))
+    return NodeTotal(uuid=uuid, name=name, up=up, down=down), None
+
+
+def komari_async_fetch_available() -> bool:
+    global _AIOHTTP_MISSING_WARNED
+    if not KOMARI_FETCH_ASYNC:
+        return False
+    if aiohttp is None:
+        if not _AIOHTTP_MISSING_WARNED:
+            logging.warning("KOMARI_FETCH_ASYNC=1 but aiohttp is not installed, using thread pool")
+            _AIOHTTP_MISSING_WARNED = True
+        return False
+    import asyncio
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return True
+    # 已在事件循环内（如 web 的 async 路由）不能再 asyncio.run
+    return False
+
+
+async def _fetch_recent_async(session, node: dict):
+    uuid = node.get("uuid")
+    name = node.get("name") or uuid
+    if not uuid:
+        return None, None
+    import asyncio
+    try:
+        async with asyncio.timeout(TIMEOUT):
+            async with session.get(f"{KOMARI_BASE_URL}/api/recent/{uuid}") as resp:
+                resp.raise_for_status()
+                recent_resp = json_loads_bytes(await resp.read())
+    except TimeoutError:
+        return None, f"{name}(timeout)"
+    except Exception as e:
+        return None, f"{name}({type(e).__name__})"
+    return parse_recent_node_total(uuid, name, recent_resp)
+
+
+async def fetch_recent_totals_async(nodes: list[dict]) -> list[tuple[NodeTotal | None, str | None]]:
+    """
+    aiohttp 并发拉取每个节点的 /api/recent，不受 KOMARI_FETCH_WORKERS 线程数限制。
+    """
+    import asyncio
+    connector = aiohttp.TCPConnector(limit=KOMARI_FETCH_ASYNC_LIMIT)
+    async with aiohttp.ClientSession(connector=connector, headers=_KOMARI_HEADERS) as session:
+        return await asyncio.gather(*[_fetch_recent_async(session, n) for n in nodes])
 
 
 def fetch_node_records(uuid: str, hours: int) -> list[dict]:
@@ -2841,10 +3374,9 @@ def fetch_node_records(uuid: str, hours: int) -> list[dict]:
         url,
         params={"uuid": uuid, "hours": int(hours)},
         timeout=TIMEOUT,
-        headers=build_komari_headers(),
     )
     r.raise_for_status()
-    payload = r.json()
+    payload = json_loads_bytes(r.content)
     if not (isinstance(payload, dict) and payload.get("status") == "success"):
         raise RuntimeError(f"/api/records/load bad response: {payload}")
     data = payload.get("data", {})
@@ -3048,13 +3580,9 @@ def build_records_summary(hours: int) -> dict:
     return result
 
 
-def build_nodes_map_from_current(current: list[NodeTotal]) -> dict:
-    return {n.uuid: {"name": n.name, "up": n.up, "down": n.down} for n in current}
-
-
 def compute_strict_sample_delta_from_maps(current_nodes_map: dict, previous_nodes_map: dict) -> tuple[dict, list[str]]:
     """
-    用于 samples.json 邻近样本之间的严格差分。
+    用于 samples.jsonl 邻近样本之间的严格差分。
 
     规则：
     - 仅对“当前样本和前一样本都存在”的节点计算差分；
@@ -3073,20 +3601,18 @@ def compute_strict_sample_delta_from_maps(current_nodes_map: dict, previous_node
             warnings.append(f"{name}(missing_prev)")
             continue
 
-        cur_up = int(cur.get("up", 0))
-        cur_down = int(cur.get("down", 0))
-        prev_up = int(prev.get("up", 0))
-        prev_down = int(prev.get("down", 0))
-
-        up_delta = cur_up - prev_up
-        down_delta = cur_down - prev_down
+        up_delta = int(cur.get("up", 0)) - int(prev.get("up", 0))
+        down_delta = int(cur.get("down", 0)) - int(prev.get("down", 0))
 
-        if up_delta < 0 or down_delta < 0:
+        # 任一差值为负时按位或结果的符号位为 1：一次比较同时判断两个方向的重置
+        if (up_delta | down_delta) < 0:
             warnings.append(f"{name}(counter_reset)")
-            up_delta = max(up_delta, 0)
-            down_delta = max(down_delta, 0)
 
-        deltas[uuid] = {"name": name, "up": up_delta, "down": down_delta}
+        deltas[uuid] = {
+            "name": name,
+            "up": up_delta if up_delta > 0 else 0,
+            "down": down_delta if down_delta > 0 else 0,
+        }
 
     return deltas, warnings
 
@@ -3102,8 +3628,8 @@ def top_lines(deltas: dict, n: int) -> list[str]:
         total = up + down
         items.append((total, down, up, name))
 
-    items.sort(reverse=True, key=lambda x: (x[0], x[1], x[2], x[3].lower()))
-    top = items[: max(0, int(n))]
+    # 只取前 n 名：nlargest 与 sorted(reverse=True)[:n] 顺序一致，但不必对全部节点排序
+    top = heapq.nlargest(max(0, int(n)), items, key=lambda x: (x[0], x[1], x[2], x[3].lower()))
 
     if not top:
         return ["（暂无数据）"]
@@ -3223,7 +3749,7 @@ def build_snapshot_hourly_total_summary(from_ts: int, to_ts: int) -> dict:
 def build_snapshot_hourly_by_node_summary(from_ts: int, to_ts: int, label_date: date | None = None) -> dict:
     samples, segments = snapshot_delta_segments(from_ts, to_ts)
     base = {
-        "date": label_date.strftime("%Y-%m-%d") if label_date else "",
+        "date": label_date.isoformat() if label_date else "",
         "from": datetime.fromtimestamp(int(from_ts), TZ).strftime("%Y-%m-%d %H:%M:%S %Z"),
         "to": datetime.fromtimestamp(int(to_ts), TZ).strftime("%Y-%m-%d %H:%M:%S %Z"),
         "sample_count": len(samples),
@@ -3343,7 +3869,7 @@ def build_live_period_struct(from_dt: datetime, to_dt: datetime | None = None, l
     expected_days = []
     d = from_day
     while d <= to_day:
-        expected_days.append(d.strftime("%Y-%m-%d"))
+        expected_days.append(d.isoformat())
         d += timedelta(days=1)
 
     covered_days = usage.get("days", [])
@@ -3406,9 +3932,9 @@ def build_today_delta_struct() -> dict | None:
     td = today_date()
     now = now_dt()
     start = start_of_day(td)
-    period = build_live_period_struct(start, now, td.strftime("%Y-%m-%d"))
+    period = build_live_period_struct(start, now, td.isoformat())
     result = {
-        "date": td.strftime("%Y-%m-%d"),
+        "date": td.isoformat(),
         "now": now.strftime("%Y-%m-%d %H:%M:%S %Z"),
         "nodes": period.get("nodes", []),
         "skipped": period.get("skipped", []),
@@ -3589,7 +4115,7 @@ def build_last_7_days_summary() -> dict:
         total = total_up + total_down
         days.append(
             {
-                "date": d.strftime("%Y-%m-%d"),
+                "date": d.isoformat(),
                 "total_up": total_up,
                 "total_down": total_down,
                 "total": total,
@@ -3680,43 +4206,49 @@ def build_ai_data_pack() -> dict:
     return pack
 
 
+def _report_warning_lines(skipped: list[str], reset_warnings: list[str]) -> list[str]:
+    lines = []
+    if skipped:
+        lines.append("")
+        lines.append("⚠️ <b>以下节点因异常被跳过</b>：")
+        lines.append("、".join(telegram_html_escape(item) for item in skipped[:30]) + ("……" if len(skipped) > 30 else ""))
+
+    if reset_warnings:
+        lines.append("")
+        lines.append("⚠️ <b>检测到计数器可能重置</b>（已兜底）：")
+        lines.append("、".join(telegram_html_escape(item) for item in reset_warnings))
+    return lines
+
+
 def format_report(title: str, period_label: str, deltas: dict, reset_warnings: list[str], skipped: list[str] | None = None, include_top: bool = True) -> str:
     skipped = skipped or []
 
-    lines = [f"📊 <b>{telegram_html_escape(title)}</b>（{telegram_html_escape(period_label)}）", ""]
-    total_up = 0
-    total_down = 0
-
     items = sorted(deltas.values(), key=lambda x: (x.get("name") or "").lower())
-    for it in items:
-        total_up += int(it["up"])
-        total_down += int(it["down"])
-        lines.append(
+    total_up = sum(int(it["up"]) for it in items)
+    total_down = sum(int(it["down"]) for it in items)
+
+    # 节点行一次性用推导式生成，最后只做一次 join
+    lines = [
+        f"📊 <b>{telegram_html_escape(title)}</b>（{telegram_html_escape(period_label)}）",
+        "",
+        *[
             f"🖥 <b>{telegram_html_escape(it['name'])}</b>\n"
             f"⬇️ 下行：{human_bytes(it['down'])}\n"
             f"⬆️ 上行：{human_bytes(it['up'])}\n"
-        )
-
-    lines.append("——")
-    lines.append(f"📦 <b>总下行</b>：{human_bytes(total_down)}")
-    lines.append(f"📦 <b>总上行</b>：{human_bytes(total_up)}")
-    lines.append(f"📦 <b>总合计</b>：{human_bytes(total_down + total_up)}")
+            for it in items
+        ],
+        "——",
+        f"📦 <b>总下行</b>：{human_bytes(total_down)}",
+        f"📦 <b>总上行</b>：{human_bytes(total_up)}",
+        f"📦 <b>总合计</b>：{human_bytes(total_down + total_up)}",
+    ]
 
     if include_top:
         lines.append("")
         lines.append(f"🔥 <b>Top {TOP_N} 消耗榜</b>（上下行合计）")
         lines.extend(top_lines(deltas, n=TOP_N))
 
-    if skipped:
-        lines.append("")
-        lines.append("⚠️ <b>以下节点因异常被跳过</b>：")
-        lines.append("、".join(telegram_html_escape(item) for item in skipped[:30]) + ("……" if len(skipped) > 30 else ""))
-
-    if reset_warnings:
-        lines.append("")
-        lines.append("⚠️ <b>检测到计数器可能重置</b>（已兜底）：")
-        lines.append("、".join(telegram_html_escape(item) for item in reset_warnings))
-
+    lines.extend(_report_warning_lines(skipped, reset_warnings))
     return "\n".join(lines)
 
 
@@ -3724,17 +4256,7 @@ def format_top_only_message(period_label: str, deltas: dict, reset_warnings: lis
     skipped = skipped or []
     lines = [f"🔥 <b>Top {TOP_N} 消耗榜</b>（上下行合计）", f"⏱ {telegram_html_escape(period_label)}", ""]
     lines.extend(top_lines(deltas, n=TOP_N))
-
-    if skipped:
-        lines.append("")
-        lines.append("⚠️ <b>以下节点因异常被跳过</b>：")
-        lines.append("、".join(telegram_html_escape(item) for item in skipped[:30]) + ("……" if len(skipped) > 30 else ""))
-
-    if reset_warnings:
-        lines.append("")
-        lines.append("⚠️ <b>检测到计数器可能重置</b>（已兜底）：")
-        lines.append("、".join(telegram_html_escape(item) for item in reset_warnings))
-
+    lines.extend(_report_warning_lines(skipped, reset_warnings))
     return "\n".join(lines)
 
 
@@ -3752,16 +4274,20 @@ def load_archive_month(ym: str) -> dict:
     path = archive_path_for_month(ym)
     if not os.path.exists(path):
         return {"days": {}}
-    with gzip.open(path, "rt", encoding="utf-8") as f:
-        return json.load(f)
+    with gzip.open(path, "rb") as f:
+        return json_loads_bytes(f.read())
 
 
 def save_archive_month(ym: str, data: dict):
     path = archive_path_for_month(ym)
     tmp = unique_temp_path(path)
     try:
-        with gzip.open(tmp, "wt", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False)
+        # 归档很少读取，用 compresslevel=1 换取更快的压缩
+        with open(tmp, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=1) as f:
+                f.write(json_dumps_bytes(data))
+            raw.flush()
+            fsync_data(raw.fileno())
         os.replace(tmp, path)
     finally:
         try:
@@ -3773,7 +4299,7 @@ def save_archive_month(ym: str, data: dict):
 
 def archive_and_prune_history():
     ensure_dirs()
-    hist = load_json(HISTORY_PATH, {"days": {}})
+    hist = load_json_cached(HISTORY_PATH, {"days": {}})
     days: dict = hist.get("days", {})
     if not days:
         return
@@ -3782,22 +4308,19 @@ def archive_and_prune_history():
     hot_cut = today - timedelta(days=HISTORY_HOT_DAYS)
     retention_cut = today - timedelta(days=HISTORY_RETENTION_DAYS)
 
+    # ISO 日期字符串按字典序即按日期排序，比较时无需解析
+    hot_cut_key = hot_cut.isoformat()
+    retention_cut_key = retention_cut.isoformat()
+
     to_keep = {}
     to_archive_by_month: dict[str, dict] = {}
 
     for k, v in days.items():
-        try:
-            d = datetime.strptime(k, "%Y-%m-%d").date()
-        except Exception:
-            continue
-
-        if d < retention_cut:
+        if not is_iso_day_key(k) or k < retention_cut_key:
             continue
 
-        if d < hot_cut:
-            ym = yyyymm(d)
-            to_archive_by_month.setdefault(ym, {})
-            to_archive_by_month[ym][k] = v
+        if k < hot_cut_key:
+            to_archive_by_month.setdefault(k[:7], {})[k] = v
         else:
             to_keep[k] = v
 
@@ -3805,21 +4328,23 @@ def archive_and_prune_history():
         arc = load_archive_month(ym)
         arc.setdefault("days", {})
         arc["days"].update(month_days)
-
-        pruned = {}
-        for dk, dv in arc["days"].items():
-            try:
-                dd = datetime.strptime(dk, "%Y-%m-%d").date()
-            except Exception:
-                continue
-            if dd >= retention_cut:
-                pruned[dk] = dv
-        arc["days"] = pruned
+        arc["days"] = {dk: dv for dk, dv in arc["days"].items() if is_iso_day_key(dk) and dk >= retention_cut_key}
         save_archive_month(ym, arc)
 
     save_json_atomic(HISTORY_PATH, {"days": to_keep})
 
 
+def submit_history_archive() -> concurrent.futures.Future:
+    """
+    在单线程归档队列中执行 archive_and_prune_history，避免重写 gzip 归档时阻塞命令处理。
+    """
+    global _ARCHIVE_POOL
+    with _ARCHIVE_POOL_LOCK:
+        if _ARCHIVE_POOL is None:
+            _ARCHIVE_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-archive")
+        return _ARCHIVE_POOL.submit(archive_and_prune_history)
+
+
 def history_sum(from_day: date, to_day: date) -> dict:
     ensure_dirs()
     period = build_daily_period_usage(start_of_day(from_day), start_of_day(to_day + timedelta(days=1)))
@@ -3834,7 +4359,7 @@ def history_sum(from_day: date, to_day: date) -> dict:
         }
 
     summed = {}
-    hot = load_json(HISTORY_PATH, {"days": {}}).get("days", {})
+    hot = load_json_cached(HISTORY_PATH, {"days": {}}).get("days", {})
 
     def add_one_day(one: dict):
         for uuid, v in one.items():
@@ -3843,15 +4368,18 @@ def history_sum(from_day: date, to_day: date) -> dict:
             summed[uuid]["up"] += int(v.get("up", 0))
             summed[uuid]["down"] += int(v.get("down", 0))
 
+    archives: dict[str, dict] = {}
     d = from_day
     while d <= to_day:
-        key = d.strftime("%Y-%m-%d")
+        key = d.isoformat()
         if key in hot:
             add_one_day(hot.get(key, {}))
         else:
-            ym = yyyymm(d)
-            arc = load_archive_month(ym).get("days", {})
-            add_one_day(arc.get(key, {}))
+            # 同一个月的归档只解压一次
+            ym = key[:7]
+            if ym not in archives:
+                archives[ym] = load_archive_month(ym).get("days", {})
+            add_one_day(archives[ym].get(key, {}))
         d += timedelta(days=1)
 
     return summed
@@ -3859,12 +4387,96 @@ def history_sum(from_day: date, to_day: date) -> dict:
 
 # -------------------- 采样器（用于连续快照、/top Nh 和告警） --------------------
 
-def load_samples():
-    return load_json(SAMPLES_PATH, {"samples": []})
+def _migrate_legacy_samples(path: str):
+    # 旧版 samples.json（整体 JSON）首次启动时转为 samples.jsonl
+    legacy = os.path.splitext(path)[0] + ".json"
+    if legacy == path or os.path.exists(path) or not os.path.exists(legacy):
+        return
+    data = load_json(legacy, {"samples": []})
+    samples = data.get("samples", []) if isinstance(data, dict) else []
+    save_jsonl_atomic(path, prune_samples(samples, max((int(x.get("ts", 0)) for x in samples), default=0)))
+    try:
+        os.remove(legacy)
+    except OSError:
+        pass
 
 
-def save_samples(data: dict):
-    save_json_atomic(SAMPLES_PATH, data)
+def _samples_state() -> dict:
+    """
+    调用方需持有 _SAMPLES_LOCK。内存中保留滚动采样，按 (mtime_ns, size) 跟随 samples.jsonl
+    （web 进程与 bot 进程共用同一文件）；文件变化时重新加载，并合并本进程尚未落盘的采样。
+    """
+    state = _SAMPLES_STATE
+    path = str(SAMPLES_PATH)
+    if state["path"] != path:
+        if state["pending"] and state["path"]:
+            try:
+                _flush_samples_locked(state)
+            except Exception:
+                logging.exception("failed to flush samples")
+        state.update(path=path, sig=None, samples=[], ts=[], pending=[], flushed_at=None, compacted_at=None)
+        try:
+            _migrate_legacy_samples(path)
+        except Exception:
+            logging.exception("failed to migrate legacy samples")
+    sig = _file_sig(path)
+    if sig != state["sig"] or (sig is None and not state["pending"]):
+        samples = _read_samples_file(path) if sig is not None else []
+        state["samples"] = _merge_samples(samples, state["pending"])
+        state["ts"] = [int(x.get("ts", 0)) for x in state["samples"]]
+        state["sig"] = sig
+    return state
+
+
+def _file_sig(path: str) -> tuple[int, int] | None:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _read_samples_file(path: str) -> list:
+    return [x for x in iter_jsonl(path) if isinstance(x, dict)]
+
+
+def _merge_samples(*groups: list) -> list:
+    # 按 ts 合并多份采样（同一 ts 以先出现者为准），再按保留时长裁剪并排序
+    merged = {}
+    for group in groups:
+        for sample in group:
+            merged.setdefault(int(sample.get("ts", 0)), sample)
+    return prune_samples(list(merged.values()), max(merged, default=0))
+
+
+def _flush_samples_locked(state: dict):
+    path = state["path"]
+    # bot 与 web 两个进程都会写 samples.jsonl：追加与压缩都在文件锁内完成
+    with file_lock(path):
+        # 追加写：只写入新采样，不重写整个文件。
+        # 追加前文件签名与上次读取一致时，内存即是最新，保留新签名免得重新解析；
+        # 否则另一进程写过，签名置空让下次读取重新加载
+        fresh = _file_sig(path) == state["sig"]
+        append_jsonl(path, state["pending"])
+        state.update(sig=_file_sig(path) if fresh else None, pending=[], flushed_at=time.monotonic())
+        compacted_at = state["compacted_at"]
+        if compacted_at is None or time.monotonic() - compacted_at >= SAMPLES_COMPACT_INTERVAL_SECONDS:
+            # 每天最多压缩一次：重读文件与内存按 ts 合并后裁剪，原子替换，不丢另一进程追加的采样
+            samples = _merge_samples(_read_samples_file(path), state["samples"])
+            save_jsonl_atomic(path, samples, durable=False)
+            state.update(
+                samples=samples,
+                ts=[int(x.get("ts", 0)) for x in samples],
+                sig=_file_sig(path),
+                compacted_at=time.monotonic(),
+            )
+
+
+def load_samples():
+    # web 进程没有采样线程：读取时顺带落盘到期的未写采样
+    flush_samples()
+    with _SAMPLES_LOCK:
+        return {"samples": list(_samples_state()["samples"])}
 
 
 def prune_samples(samples: list, now_ts: int):
@@ -3874,23 +4486,71 @@ def prune_samples(samples: list, now_ts: int):
     return pruned
 
 
+def append_sample(sample: dict, now_ts: int):
+    """
+    追加一条采样到内存并按保留时长裁剪；落盘由 flush_samples 合并执行。
+    """
+    with _SAMPLES_LOCK:
+        state = _samples_state()
+        samples, ts_index = state["samples"], state["ts"]
+        sample_ts = int(sample.get("ts", 0))
+        if not ts_index or sample_ts >= ts_index[-1]:
+            samples.append(sample)
+            ts_index.append(sample_ts)
+        else:
+            pos = bisect.bisect_right(ts_index, sample_ts)
+            samples.insert(pos, sample)
+            ts_index.insert(pos, sample_ts)
+        cut = bisect.bisect_left(ts_index, now_ts - SAMPLE_RETENTION_HOURS * 3600)
+        if cut:
+            del samples[:cut]
+            del ts_index[:cut]
+        state["pending"].append(sample)
+    flush_samples()
+
+
+def latest_sample() -> dict | None:
+    flush_samples()
+    with _SAMPLES_LOCK:
+        samples = _samples_state()["samples"]
+        return samples[-1] if samples else None
+
+
+def flush_samples(force: bool = False) -> bool:
+    """
+    将未落盘的采样追加到 samples.jsonl：默认最多每 SAMPLE_FLUSH_SECONDS 写一次，force=True 立即写入。
+    """
+    with _SAMPLES_LOCK:
+        state = _SAMPLES_STATE
+        if not state["pending"]:
+            return False
+        flushed_at = state["flushed_at"]
+        if not force and flushed_at is not None and time.monotonic() - flushed_at < SAMPLE_FLUSH_SECONDS:
+            return False
+        try:
+            _flush_samples_locked(state)
+        except Exception:
+            logging.exception("failed to flush samples")
+            return False
+        return True
+
+
 def take_sample_if_due(force: bool = False, record: bool = True, source: str = "sample-worker"):
     """
     由 bot 循环周期性调用：最多每 SAMPLE_INTERVAL_SECONDS 采样一次
     """
     ensure_dirs()
-    data = load_samples()
-    samples = data.get("samples", [])
+    with _SAMPLES_LOCK:
+        ts_index = _samples_state()["ts"]
+        last_ts = ts_index[-1] if ts_index else 0
     now_ts = int(time.time())
 
-    last_ts = int(samples[-1]["ts"]) if samples else 0
     if (not force) and last_ts and (now_ts - last_ts < SAMPLE_INTERVAL_SECONDS):
         return
 
     started = time.time()
     try:
-        current, skipped = fetch_nodes_and_totals()
-        nodes_map = build_nodes_map_from_current(current)
+        _, nodes_map, skipped = fetch_nodes_and_totals()
 
         save_traffic_snapshot(now_ts, nodes_map, skipped)
         segment_result = materialize_latest_traffic_segment(now_ts)
@@ -3904,9 +4564,7 @@ def take_sample_if_due(force: bool = False, record: bool = True, source: str = "
         except Exception:
             logging.exception("failed to prune traffic_segments")
 
-        samples.append({"ts": now_ts, "nodes": nodes_map, "skipped": skipped})
-        samples = prune_samples(samples, now_ts)
-        save_samples({"samples": samples})
+        append_sample({"ts": now_ts, "nodes": nodes_map, "skipped": skipped}, now_ts)
         if record:
             safe_record_task_run(
                 "sample",
@@ -4024,7 +4682,9 @@ def sample_worker_loop():
                 last_vacuum_date = now_value.date()
         except Exception:
             logging.exception("sample worker error")
+        flush_samples()
         SAMPLE_STOP_EVENT.wait(timeout=max(1, SAMPLE_INTERVAL_SECONDS))
+    flush_samples(force=True)
     logging.info("sample worker stopped")
 
 
@@ -4041,6 +4701,7 @@ def stop_sample_worker():
     SAMPLE_STOP_EVENT.set()
     if SAMPLE_THREAD and SAMPLE_THREAD.is_alive():
         SAMPLE_THREAD.join(timeout=3)
+    flush_samples(force=True)
 
 
 # -------------------- 智能告警 --------------------
@@ -4170,9 +4831,7 @@ def collect_alert_candidates(state: dict, now_ts: int | None = None) -> list[dic
     now_ts = now_ts or int(time.time())
     candidates: list[dict] = []
 
-    samples_data = load_samples()
-    samples = samples_data.get("samples", []) if isinstance(samples_data, dict) else []
-    latest = samples[-1] if samples else None
+    latest = latest_sample()
 
     if latest:
         latest_ts = int(latest.get("ts", now_ts) or now_ts)
@@ -4387,7 +5046,7 @@ def _run_alert_check_impl(dry_run: bool = False, notify: bool = True, force_samp
         take_sample_if_due(force=True, record=False, source="alert-check")
 
     state = load_alerts_state()
-    work_state = json.loads(json.dumps(state)) if dry_run else state
+    work_state = json_loads_bytes(json_dumps_bytes(state)) if dry_run else state
     candidates = collect_alert_candidates(work_state, now_ts=now_ts)
     events = apply_alert_candidates(work_state, candidates, now_ts=now_ts, dry_run=dry_run)
 
@@ -4563,15 +5222,15 @@ def scheduled_report_period_parts(scope: str):
     td = today_date()
     if scope == "daily":
         prev_day = td - timedelta(days=1)
-        return start_of_day(prev_day), start_of_day(td), prev_day.strftime("%Y-%m-%d")
+        return start_of_day(prev_day), start_of_day(td), prev_day.isoformat()
     if scope == "weekly":
         this_week_start = start_of_week(td)
         prev_week_start = this_week_start - timedelta(days=7)
-        return start_of_day(prev_week_start), start_of_day(this_week_start), f"WEEK-{prev_week_start.strftime('%Y-%m-%d')}"
+        return start_of_day(prev_week_start), start_of_day(this_week_start), f"WEEK-{prev_week_start.isoformat()}"
     if scope == "monthly":
         this_month_start = start_of_month(td)
         prev_month_start = start_of_month(this_month_start - timedelta(days=1))
-        return start_of_day(prev_month_start), start_of_day(this_month_start), f"MONTH-{prev_month_start.strftime('%Y-%m-%d')}"
+        return start_of_day(prev_month_start), start_of_day(this_month_start), f"MONTH-{prev_month_start.isoformat()}"
     raise RuntimeError("scope must be daily, weekly, or monthly")
 
 
@@ -4661,7 +5320,7 @@ def scheduler_worker_loop():
             if changed:
                 save_report_schedules(data)
         except Exception:
-            logging.exception("report scheduler error")
+            log_exception_throttled("report_scheduler", "report scheduler error")
         SCHEDULER_STOP_EVENT.wait(timeout=30)
     logging.info("report scheduler stopped")
 
@@ -4758,13 +5417,16 @@ def is_admin(chat_id: str) -> bool:
 
 # -------------------- Telegram 命令监听 --------------------
 
+_TG_EMPTY_UPDATES = b'{"ok":true,"result":[]}'
+
+
 def get_updates(offset: int | None):
     """
     Telegram long polling 在公网环境下偶发被对端 reset 是正常的。
     这里做：网络错误自动重试 + 轻量退避，避免刷屏告警/频繁重连。
     """
     url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getUpdates"
-    params = {"timeout": 50}
+    params = {"timeout": TG_POLL_TIMEOUT}
     if offset is not None:
         params["offset"] = offset
 
@@ -4773,9 +5435,13 @@ def get_updates(offset: int | None):
     last_exc = None
     for _ in range(5):
         try:
-            r = requests.get(url, params=params, timeout=55)
+            r = telegram_poll_session().get(url, params=params, timeout=TG_POLL_TIMEOUT + 5)
             r.raise_for_status()
-            return r.json()
+            body = r.content
+            # 长轮询超时返回空结果是最常见的情况，直接比较字节跳过 JSON 解析
+            if body == _TG_EMPTY_UPDATES:
+                return {"ok": True, "result": []}
+            return json_loads_bytes(body)
         except requests.HTTPError as e:
             if e.response is not None and e.response.status_code == 409:
                 if should_alert("tg_409", 600):
@@ -4785,7 +5451,9 @@ def get_updates(offset: int | None):
                 requests.exceptions.ReadTimeout,
                 requests.exceptions.ChunkedEncodingError) as e:
             last_exc = e
-            time.sleep(backoff + random.random())
+            # 退避期间收到 SIGTERM 立即返回空结果，由外层循环收尾退出
+            if SHUTDOWN_EVENT.wait(backoff + random.random()):
+                return {"ok": True, "result": []}
             backoff = min(backoff * 2, 20.0)
             continue
 
@@ -4805,9 +5473,40 @@ def load_offset() -> int | None:
 
 
 def save_offset(val: int):
+    # 写入已由 flush_offset 合并到每 TG_OFFSET_FLUSH_SECONDS 最多一次，fsync 成本可以接受
     save_text_atomic(TG_OFFSET_PATH, str(val))
 
 
+def queue_offset(val: int):
+    _TG_OFFSET_STATE["pending"] = val
+
+
+def flush_offset(force: bool = False):
+    """
+    把内存中的 offset 写入 tg_offset.txt：值未变化时跳过，否则最多每 TG_OFFSET_FLUSH_SECONDS 写一次；
+    force=True（退出时）立即写入。
+    """
+    state = _TG_OFFSET_STATE
+    val = state["pending"]
+    if val is None or val == state["saved"]:
+        return
+    now = time.monotonic()
+    if not force and state["flushed_at"] is not None and now - state["flushed_at"] < TG_OFFSET_FLUSH_SECONDS:
+        return
+    save_offset(val)
+    state["saved"] = val
+    state["flushed_at"] = now
+
+
+# /top 参数：固定周期（含简写）查表，其余再尝试 Nh；小时数限制位数，避免超大值让 timedelta 溢出
+_TOP_PERIOD = {
+    "today": "today", "t": "today",
+    "week": "week", "w": "week",
+    "month": "month", "m": "month",
+}
+_TOP_HOURS_RE = re.compile(r"(\d{1,5})h")
+
+
 def parse_top_scope(text: str):
     """
     /top
@@ -4818,25 +5517,213 @@ def parse_top_scope(text: str):
     if len(parts) == 1:
         return ("today", None)
 
-    arg = parts[1].strip().lower()
-    if arg in ("today", "t"):
-        return ("today", None)
-    if arg in ("week", "w"):
-        return ("week", None)
-    if arg in ("month", "m"):
-        return ("month", None)
+    arg = parts[1].lower()
+    scope = _TOP_PERIOD.get(arg)
+    if scope is not None:
+        return (scope, None)
 
-    m = re.fullmatch(r"(\d+)\s*h", arg)
+    m = _TOP_HOURS_RE.fullmatch(arg)
     if m:
         return ("hours", int(m.group(1)))
 
     return ("unknown", None)
 
 
-def listen_commands():
-    ensure_dirs()
-    logging.info("Komari traffic bot starting (stat_tz=%s)", STAT_TZ)
+def _run_scope_report(scope: str, top_only: bool):
+    td = today_date()
+    if scope == "week":
+        start = start_of_week(td)
+        tag = f"WEEK-{start.isoformat()}"
+    elif scope == "month":
+        start = start_of_month(td)
+        tag = f"MONTH-{start.isoformat()}"
+    else:
+        start = td
+        tag = td.isoformat()
+    run_period_report(start_of_day(start), now_dt(), tag, top_only=top_only)
+
+
+def _admin_only(handler):
+    def wrapped(chat_id: str, text: str, arg_text: str):
+        if not is_admin(chat_id):
+            telegram_send("⛔ 无权限")
+            return
+        handler(chat_id, text, arg_text)
+    return wrapped
+
+
+def _cmd_today(chat_id: str, text: str, arg_text: str):
+    _run_scope_report("today", top_only=False)
+
+
+def _cmd_week(chat_id: str, text: str, arg_text: str):
+    _run_scope_report("week", top_only=False)
+
+
+def _cmd_month(chat_id: str, text: str, arg_text: str):
+    _run_scope_report("month", top_only=False)
+
+
+def _cmd_top(chat_id: str, text: str, arg_text: str):
+    scope, hours = parse_top_scope(text)
+    if scope in ("today", "week", "month"):
+        _run_scope_report(scope, top_only=True)
+    elif scope == "hours":
+        run_top_last_hours(int(hours or 0))
+    else:
+        telegram_send("用法：/top  或  /top today|week|month  或  /top 6h")
 
+
+def _cmd_archive(chat_id: str, text: str, arg_text: str):
+    code, _ = set_confirm_action(chat_id, "archive")
+    telegram_send(
+        "⚠️ 准备执行 archive（归档 + 清理 history 热数据）。\n"
+        f"当前时间：{now_dt().strftime('%Y-%m-%d %H:%M:%S %Z')}\n"
+        f"如需继续，请发送：/confirm_archive {code}"
+    )
+
+
+def _cmd_alerts(chat_id: str, text: str, arg_text: str):
+    telegram_send(format_alert_status())
+
+
+def _cmd_mute_alerts(chat_id: str, text: str, arg_text: str):
+    try:
+        hours = parse_mute_hours_arg(arg_text)
+    except Exception as e:
+        telegram_send(str(e))
+        return
+    muted_until = set_alerts_muted_for(hours)
+    telegram_send(f"✅ 已静默告警至：<code>{muted_until.strftime('%Y-%m-%d %H:%M:%S %Z')}</code>")
+
+
+def _cmd_unmute_alerts(chat_id: str, text: str, arg_text: str):
+    clear_alerts_muted()
+    telegram_send("✅ 已解除告警静默")
+
+
+def _cmd_confirm_archive(chat_id: str, text: str, arg_text: str):
+    code = arg_text.strip()
+    if not consume_confirm_action(chat_id, "archive", code):
+        telegram_send("❌ 确认码无效或已过期")
+        return
+
+    def notify_done(future: concurrent.futures.Future):
+        try:
+            future.result()
+        except Exception as e:
+            logging.exception("history archive failed")
+            telegram_send(f"❌ 历史归档失败：{telegram_html_escape(redact_sensitive_text(str(e)))}")
+            return
+        telegram_send("✅ 已执行历史归档压缩")
+
+    submit_history_archive().add_done_callback(notify_done)
+
+
+def _cmd_ask(chat_id: str, text: str, arg_text: str):
+    question = text.partition(" ")[2].strip()
+    if not question:
+        telegram_send(
+            "用法：/ask 你的问题\n"
+            "示例：\n"
+            "/ask 今天哪个节点最耗流量？\n"
+            "/ask 最近 7 天流量大概是上升还是下降趋势？\n"
+            "/ask 帮我写一段今天流量情况的总结，适合发到群里。"
+        )
+        return
+
+    if question_requires_fresh_ai_pack(question):
+        data_pack = build_ai_data_pack()
+    else:
+        data_pack = get_ai_data_pack_cached()
+    answer = ask_ai_with_data(question, data_pack)
+    # 回复经发送队列投递，HTML 解析失败的纯文本回退由 deliver_telegram_reply 负责
+    telegram_send(normalize_ai_answer_for_telegram(answer))
+
+
+_HELP_TEXT = (
+    "可用命令：\n"
+    "/today  /week  /month\n"
+    "/top  (默认 today)\n"
+    "/top today|week|month\n"
+    "/top 6h（任意Nh）\n"
+    "/ask 你的问题（或 /ai）\n"
+    "管理员：/alerts /mute_alerts 2h /unmute_alerts\n"
+    "/archive\n"
+    "确认命令：/confirm_archive"
+)
+
+
+def _cmd_help(chat_id: str, text: str, arg_text: str):
+    telegram_send(_HELP_TEXT)
+
+
+# 命令 -> 处理函数：handler(chat_id, text, arg_text)
+_COMMANDS = {
+    "/today": _cmd_today,
+    "/week": _cmd_week,
+    "/month": _cmd_month,
+    "/top": _cmd_top,
+    "/archive": _admin_only(_cmd_archive),
+    "/alerts": _admin_only(_cmd_alerts),
+    "/mute_alerts": _admin_only(_cmd_mute_alerts),
+    "/unmute_alerts": _admin_only(_cmd_unmute_alerts),
+    "/confirm_archive": _admin_only(_cmd_confirm_archive),
+    "/ask": _cmd_ask,
+    "/ai": _cmd_ask,
+    "/help": _cmd_help,
+    "/start": _cmd_help,
+}
+
+
+# /cmd、/cmd@BotName（群聊里点选命令）与第一个参数；arg 为空串表示无参数
+_CMD_RE = re.compile(r"/(\w+)(?:@(\w+))?(?=\s|$)\s*(\S*)")
+
+
+@functools.lru_cache(maxsize=1)
+def telegram_bot_username() -> str:
+    """本 bot 的 username（小写），首次调用 getMe 后缓存；失败时抛异常且不缓存。"""
+    data = telegram_api_call("getMe", {})
+    return str((data.get("result") or {}).get("username") or "").lower()
+
+
+def is_command_for_other_bot(target: str | None) -> bool:
+    """群里多个 bot 时 /cmd@OtherBot 不归本 bot 处理；取不到自身 username 时按本 bot 处理。"""
+    if not target:
+        return False
+    try:
+        own = telegram_bot_username()
+    except Exception as e:
+        logging.warning("getMe failed: %s", redact_sensitive_data(str(e)))
+        return False
+    return bool(own) and target.lower() != own
+
+
+def handle_update(upd: dict):
+    """
+    处理单个 Telegram update（getUpdates 与 webhook 共用）。
+    offset 由调用方在分发前推进，处理函数抛异常也不会反复拉到同一条 update。
+    """
+    msg = upd.get("message") or upd.get("edited_message")
+    if not msg:
+        return
+
+    chat = msg.get("chat", {})
+    chat_id = str(chat.get("id", ""))
+    if not is_allowed_chat(chat_id):
+        return
+
+    text = (msg.get("text") or "").strip()
+    m = _CMD_RE.match(text)
+    if not m or is_command_for_other_bot(m.group(2)):
+        return
+
+    handler = _COMMANDS.get("/" + m.group(1).lower())
+    if handler is not None:
+        handler(chat_id, text, m.group(3))
+
+
+def start_bot_sampling():
     # 启动先采一次样；采样是实时统计主链路，不依赖 Telegram/报表推送。
     try:
         take_sample_if_due(force=True)
@@ -4845,13 +5732,8 @@ def listen_commands():
         logging.exception("initial sample or alert check failed")
     start_sample_worker()
 
-    if not telegram_configured():
-        logging.warning("TELEGRAM_BOT_TOKEN / TELEGRAM_CHAT_ID 未设置，进入仅采样模式")
-        while not SHUTTING_DOWN:
-            time.sleep(3)
-        stop_sample_worker()
-        return
 
+def notify_bot_started():
     if BOT_START_NOTIFY and should_alert("bot_start", 60):
         instance_label = BOT_INSTANCE_NAME or "default"
         allowed_chats = parse_chat_ids_env("TELEGRAM_ALLOWED_CHAT_IDS", str(TELEGRAM_CHAT_ID))
@@ -4861,234 +5743,269 @@ def listen_commands():
             f"🕒 统计时区：{STAT_TZ}\n"
             f"💬 可接收命令 chat 数：{len(allowed_chats)}"
         )
+
+
+def reload_runtime_config_if_changed(last_mtime: float | None) -> float | None:
+    """runtime_config.json（Web 面板写入）变化时重新加载，返回最新 mtime。"""
+    try:
+        config_path = runtime_config_path()
+        if os.path.exists(config_path):
+            current_mtime = os.path.getmtime(config_path)
+            if last_mtime is not None and current_mtime != last_mtime:
+                logging.info("runtime_config.json changed, reloading")
+                config = load_runtime_config()
+                apply_runtime_config(config)
+            return current_mtime
+    except Exception:
+        log_exception_throttled("runtime_config_reload", "failed to check/reload runtime config")
+    return last_mtime
+
+
+def listen_backoff_seconds(attempt: int) -> float:
+    """指数退避 + 全抖动：第 attempt 次连续失败后等待 [0, min(30, 0.5 * 2^attempt)) 秒。"""
+    return random.uniform(0, min(30.0, 0.5 * (2 ** attempt)))
+
+
+def listen_commands():
+    ensure_dirs()
+    logging.info("Komari traffic bot starting (stat_tz=%s)", STAT_TZ)
+    start_bot_sampling()
+
+    if not telegram_configured():
+        logging.warning("TELEGRAM_BOT_TOKEN / TELEGRAM_CHAT_ID 未设置，进入仅采样模式")
+        SHUTDOWN_EVENT.wait()
+        stop_sample_worker()
+        return
+
+    notify_bot_started()
     offset = load_offset()
+    _TG_OFFSET_STATE["saved"] = offset
+    start_telegram_sender()
     start_report_scheduler()
 
     _last_config_mtime = None
-    while True:
-        if SHUTTING_DOWN:
-            logging.warning("shutdown flag set, exiting listen loop")
-            stop_sample_worker()
-            stop_report_scheduler()
-            return
-
+    attempt = 0
+    while not SHUTDOWN_EVENT.is_set():
         # Check for runtime config changes
-        try:
-            config_path = runtime_config_path()
-            if os.path.exists(config_path):
-                current_mtime = os.path.getmtime(config_path)
-                if _last_config_mtime is None:
-                    _last_config_mtime = current_mtime
-                elif current_mtime != _last_config_mtime:
-                    logging.info("runtime_config.json changed, reloading")
-                    config = load_runtime_config()
-                    apply_runtime_config(config)
-                    _last_config_mtime = current_mtime
-        except Exception:
-            logging.exception("failed to check/reload runtime config")
+        _last_config_mtime = reload_runtime_config_if_changed(_last_config_mtime)
 
         try:
             data = get_updates(offset)
             if not data.get("ok"):
-                time.sleep(3)
+                attempt = min(attempt + 1, 6)
+                SHUTDOWN_EVENT.wait(listen_backoff_seconds(attempt))
                 continue
+            attempt = 0
 
-            for upd in data.get("result", []):
-                update_id = upd.get("update_id")
-                if update_id is not None:
-                    offset = update_id + 1
+            # 同一批 updates 的回复按 chat 合并发送，offset 整批处理完只落盘一次
+            with telegram_reply_batch():
+                for upd in data.get("result", []):
+                    # 先推进 offset 再分发：处理失败的 update 不会在下一轮被重复拉取
+                    update_id = upd.get("update_id")
+                    if update_id is not None:
+                        offset = update_id + 1
+                        queue_offset(offset)
+                    handle_update(upd)
 
-                msg = upd.get("message") or upd.get("edited_message")
-                if not msg:
-                    continue
+            flush_offset()
 
-                chat = msg.get("chat", {})
-                chat_id = str(chat.get("id", ""))
-                if not is_allowed_chat(chat_id):
-                    continue
+        except Exception as e:
+            redacted_msg = redact_sensitive_data(str(e))
+            # 同一故障持续时只在告警窗口内记 error，其余降级为 warning
+            if should_alert("listen", 300):
+                alert_exception("listen_loop", "listen", e)
+                logging.error("listen loop error: %s", redacted_msg)
+            else:
+                logging.warning("listen loop error: %s", redacted_msg)
+            attempt = min(attempt + 1, 6)
+            SHUTDOWN_EVENT.wait(listen_backoff_seconds(attempt))
 
-                text = (msg.get("text") or "").strip()
-                if not text.startswith("/"):
-                    continue
+    # 收尾：offset 落盘、后台线程退出、发送队列里剩余回复发完
+    logging.warning("shutdown flag set, exiting listen loop")
+    flush_offset(force=True)
+    stop_sample_worker()
+    stop_report_scheduler()
+    stop_telegram_sender()
 
-                parts = text.split()
-                cmd = parts[0].lower()
-                arg_text = parts[1] if len(parts) > 1 else ""
-
-                now = now_dt()
-                td = today_date()
-
-                if cmd == "/today":
-                    tag = td.strftime("%Y-%m-%d")
-                    run_period_report(start_of_day(td), now, tag, top_only=False)
-
-                elif cmd == "/week":
-                    ws = start_of_week(td)
-                    tag = f"WEEK-{ws.strftime('%Y-%m-%d')}"
-                    run_period_report(start_of_day(ws), now, tag, top_only=False)
-
-                elif cmd == "/month":
-                    ms = start_of_month(td)
-                    tag = f"MONTH-{ms.strftime('%Y-%m-%d')}"
-                    run_period_report(start_of_day(ms), now, tag, top_only=False)
-
-                elif cmd == "/top":
-                    scope, hours = parse_top_scope(text)
-                    if scope == "today":
-                        tag = td.strftime("%Y-%m-%d")
-                        run_period_report(start_of_day(td), now, tag, top_only=True)
-                    elif scope == "week":
-                        ws = start_of_week(td)
-                        tag = f"WEEK-{ws.strftime('%Y-%m-%d')}"
-                        run_period_report(start_of_day(ws), now, tag, top_only=True)
-                    elif scope == "month":
-                        ms = start_of_month(td)
-                        tag = f"MONTH-{ms.strftime('%Y-%m-%d')}"
-                        run_period_report(start_of_day(ms), now, tag, top_only=True)
-                    elif scope == "hours":
-                        run_top_last_hours(int(hours or 0))
-                    else:
-                        telegram_send("用法：/top  或  /top today|week|month  或  /top 6h")
 
-                elif cmd == "/archive":
-                    if not is_admin(chat_id):
-                        telegram_send("⛔ 无权限")
-                        continue
-                    code, _ = set_confirm_action(chat_id, "archive")
-                    telegram_send(
-                        "⚠️ 准备执行 archive（归档 + 清理 history 热数据）。\n"
-                        f"当前时间：{now.strftime('%Y-%m-%d %H:%M:%S %Z')}\n"
-                        f"如需继续，请发送：/confirm_archive {code}"
-                    )
+# -------------------- Telegram webhook --------------------
 
-                elif cmd == "/alerts":
-                    if not is_admin(chat_id):
-                        telegram_send("⛔ 无权限")
-                        continue
-                    telegram_send(format_alert_status())
+_TG_WEBHOOK_SECRET_RE = re.compile(r"[A-Za-z0-9_-]{1,256}")
+_WEBHOOK_UPDATE_LOCK = threading.Lock()
 
-                elif cmd == "/mute_alerts":
-                    if not is_admin(chat_id):
-                        telegram_send("⛔ 无权限")
-                        continue
-                    try:
-                        hours = parse_mute_hours_arg(arg_text)
-                    except Exception as e:
-                        telegram_send(str(e))
-                        continue
-                    muted_until = set_alerts_muted_for(hours)
-                    telegram_send(f"✅ 已静默告警至：<code>{muted_until.strftime('%Y-%m-%d %H:%M:%S %Z')}</code>")
 
-                elif cmd == "/unmute_alerts":
-                    if not is_admin(chat_id):
-                        telegram_send("⛔ 无权限")
-                        continue
-                    clear_alerts_muted()
-                    telegram_send("✅ 已解除告警静默")
+def telegram_api_call(method: str, payload: dict):
+    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/{method}"
+    data = post_json(url, payload)
+    if not data.get("ok"):
+        raise RuntimeError(f"Telegram {method} failed: {data.get('description') or data}")
+    return data
 
-                elif cmd == "/confirm_archive":
-                    if not is_admin(chat_id):
-                        telegram_send("⛔ 无权限")
-                        continue
-                    code = arg_text.strip()
-                    if not consume_confirm_action(chat_id, "archive", code):
-                        telegram_send("❌ 确认码无效或已过期")
-                        continue
-                    archive_and_prune_history()
-                    telegram_send("✅ 已执行历史归档压缩")
-
-                elif cmd in ("/ask", "/ai"):
-                    question = text.partition(" ")[2].strip()
-                    if not question:
-                        telegram_send(
-                            "用法：/ask 你的问题\n"
-                            "示例：\n"
-                            "/ask 今天哪个节点最耗流量？\n"
-                            "/ask 最近 7 天流量大概是上升还是下降趋势？\n"
-                            "/ask 帮我写一段今天流量情况的总结，适合发到群里。"
-                        )
-                        continue
 
-                    if question_requires_fresh_ai_pack(question):
-                        data_pack = build_ai_data_pack()
-                    else:
-                        data_pack = get_ai_data_pack_cached()
-                    answer = ask_ai_with_data(question, data_pack)
-                    ai_text = normalize_ai_answer_for_telegram(answer)
-                    try:
-                        telegram_send(ai_text)
-                    except requests.exceptions.HTTPError as e:
-                        if e.response is not None and e.response.status_code == 400:
-                            logging.warning("telegram html parse failed, fallback to plain text send")
-                            telegram_send_plain(re.sub(r"</?[^>]+>", "", ai_text))
-                        else:
-                            raise
-
-                elif cmd in ("/help", "/start"):
-                    telegram_send(
-                        "可用命令：\n"
-                        "/today  /week  /month\n"
-                        "/top  (默认 today)\n"
-                        "/top today|week|month\n"
-                        "/top 6h（任意Nh）\n"
-                        "/ask 你的问题（或 /ai）\n"
-                        "管理员：/alerts /mute_alerts 2h /unmute_alerts\n"
-                        "/archive\n"
-                        "确认命令：/confirm_archive"
-                    )
+def process_webhook_update(upd: dict):
+    # 与轮询模式一致：update 串行处理，避免命令并发改写状态文件
+    with _WEBHOOK_UPDATE_LOCK:
+        try:
+            with telegram_reply_batch():
+                handle_update(upd)
+        except Exception as e:
+            if should_alert("webhook", 300):
+                alert_exception("webhook", "webhook", e)
+            logging.error("webhook update error: %s", redact_sensitive_data(str(e)))
+
 
-            if offset is not None:
-                save_offset(offset)
+class TelegramWebhookHandler(http.server.BaseHTTPRequestHandler):
+    server_version = "komari-traffic-bot"
 
+    def do_POST(self):
+        secret = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not secrets.compare_digest(secret.encode("utf-8"), TELEGRAM_WEBHOOK_SECRET.encode("utf-8")):
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length <= 0 or length > TELEGRAM_WEBHOOK_MAX_BODY:
+            self.send_error(400)
+            return
+        try:
+            upd = json_loads_bytes(self.rfile.read(length))
+        except ValueError:
+            upd = None
+        if not isinstance(upd, dict):
+            self.send_error(400)
+            return
+
+        # 先回 200 再处理：报表/AI 命令较慢，避免 Telegram 等待超时后重复投递
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        process_webhook_update(upd)
+
+    def log_message(self, format, *args):
+        logging.debug("webhook %s - %s", self.address_string(), format % args)
+
+
+def validate_webhook_config_or_raise():
+    if not telegram_configured():
+        raise RuntimeError("TELEGRAM_BOT_TOKEN / TELEGRAM_CHAT_ID 未设置")
+    if not TELEGRAM_WEBHOOK_URL.startswith("https://"):
+        raise RuntimeError("TELEGRAM_WEBHOOK_URL must be an https:// URL")
+    if not _TG_WEBHOOK_SECRET_RE.fullmatch(TELEGRAM_WEBHOOK_SECRET):
+        raise RuntimeError("TELEGRAM_WEBHOOK_SECRET must be 1-256 chars of A-Z, a-z, 0-9, _ or -")
+    if not (0 < TELEGRAM_WEBHOOK_PORT < 65536):
+        raise RuntimeError("TELEGRAM_WEBHOOK_PORT must be between 1 and 65535")
+
+
+def run_webhook():
+    validate_webhook_config_or_raise()
+    ensure_dirs()
+    logging.info("Komari traffic bot starting in webhook mode (stat_tz=%s)", STAT_TZ)
+    start_bot_sampling()
+
+    server = http.server.ThreadingHTTPServer((TELEGRAM_WEBHOOK_HOST, TELEGRAM_WEBHOOK_PORT), TelegramWebhookHandler)
+    server.daemon_threads = True
+    server_thread = threading.Thread(target=server.serve_forever, name="telegram-webhook", daemon=True)
+    server_thread.start()
+    try:
+        telegram_api_call("setWebhook", {
+            "url": TELEGRAM_WEBHOOK_URL,
+            "secret_token": TELEGRAM_WEBHOOK_SECRET,
+            "allowed_updates": ["message", "edited_message"],
+        })
+        logging.info("telegram webhook set, listening on %s:%s", TELEGRAM_WEBHOOK_HOST, TELEGRAM_WEBHOOK_PORT)
+        notify_bot_started()
+        start_telegram_sender()
+        start_report_scheduler()
+
+        _last_config_mtime = None
+        while not SHUTDOWN_EVENT.is_set():
+            _last_config_mtime = reload_runtime_config_if_changed(_last_config_mtime)
+            SHUTDOWN_EVENT.wait(1)
+        logging.warning("shutdown flag set, stopping webhook server")
+    finally:
+        server.shutdown()
+        server.server_close()
+        try:
+            # 删除 webhook，之后切回 listen（getUpdates）模式不会 409
+            telegram_api_call("deleteWebhook", {})
         except Exception as e:
-            if should_alert("listen", 300):
-                alert_exception("listen_loop", "listen", e)
-            redacted_msg = redact_sensitive_data(str(e))
-            logging.error("listen loop error: %s", redacted_msg)
-            time.sleep(3)
+            logging.error("deleteWebhook failed: %s", redact_sensitive_data(str(e)))
+        stop_sample_worker()
+        stop_report_scheduler()
+        stop_telegram_sender()
 
 # -------------------- main --------------------
 
-def main():
-    if len(sys.argv) < 2:
-        raise RuntimeError("Usage: report_daily | report_weekly | report_monthly | listen | check_alerts [--dry-run] | health | config-validate")
+def _cli_report_daily(args: list[str]):
+    run_with_task_record("report", "cli:report_daily", run_daily_send_yesterday, summary_func=lambda _result: "昨日流量日报")
 
-    cmd = sys.argv[1].strip().lower()
 
-    if cmd == "report_daily":
-        run_with_task_record("report", "cli:report_daily", run_daily_send_yesterday, summary_func=lambda _result: "昨日流量日报")
-        return 0
-    if cmd == "report_weekly":
-        run_with_task_record("report", "cli:report_weekly", run_weekly_send_last_week, summary_func=lambda _result: "上周流量周报")
-        return 0
-    if cmd == "report_monthly":
-        run_with_task_record("report", "cli:report_monthly", run_monthly_send_last_month, summary_func=lambda _result: "上月流量月报")
-        return 0
-    if cmd == "listen":
-        listen_commands()
-        return 0
-    if cmd in ("check_alerts", "check-alerts"):
-        dry_run = False
-        for arg in sys.argv[2:]:
-            if arg.strip().lower() == "--dry-run":
+def _cli_report_weekly(args: list[str]):
+    run_with_task_record("report", "cli:report_weekly", run_weekly_send_last_week, summary_func=lambda _result: "上周流量周报")
+
+
+def _cli_report_monthly(args: list[str]):
+    run_with_task_record("report", "cli:report_monthly", run_monthly_send_last_month, summary_func=lambda _result: "上月流量月报")
+
+
+def _cli_listen(args: list[str]):
+    listen_commands()
+
+
+def _cli_webhook(args: list[str]):
+    run_webhook()
+
+
+def _cli_check_alerts(args: list[str]):
+    dry_run = False
+    for arg in args:
+        match arg.strip().lower():
+            case "--dry-run":
                 dry_run = True
-                continue
-            raise RuntimeError(f"Unknown check_alerts arg: {arg}")
-        validate_config_or_raise()
-        result = run_alert_check(dry_run=dry_run, notify=not dry_run, force_sample=True)
-        print(format_alert_check_result(result))
-        return 0
-    if cmd == "config-validate":
-        validate_config_or_raise()
-        print("OK")
-        return 0
-    if cmd == "health":
-        validate_config_or_raise()
-        run_healthcheck_or_raise()
-        print("OK")
-        return 0
+            case _:
+                raise RuntimeError(f"Unknown check_alerts arg: {arg}")
+    validate_config_or_raise()
+    result = run_alert_check(dry_run=dry_run, notify=not dry_run, force_sample=True)
+    print(format_alert_check_result(result))
+
+
+def _cli_config_validate(args: list[str]):
+    validate_config_or_raise()
+    print("OK")
+
+
+def _cli_health(args: list[str]):
+    validate_config_or_raise()
+    run_healthcheck_or_raise()
+    print("OK")
+
 
-    raise RuntimeError("Unknown command")
+# 子命令 -> 处理函数：handler(args)，args 为子命令之后的参数
+_CMDS = {
+    "report_daily": _cli_report_daily,
+    "report_weekly": _cli_report_weekly,
+    "report_monthly": _cli_report_monthly,
+    "listen": _cli_listen,
+    "webhook": _cli_webhook,
+    "check_alerts": _cli_check_alerts,
+    "check-alerts": _cli_check_alerts,
+    "config-validate": _cli_config_validate,
+    "health": _cli_health,
+}
+
+
+def main():
+    if len(sys.argv) < 2:
+        raise RuntimeError("Usage: report_daily | report_weekly | report_monthly | listen | webhook | check_alerts [--dry-run] | health | config-validate")
+
+    cmd = sys.argv[1].strip().lower()
+    handler = _CMDS.get(cmd)
+    if handler is None:
+        raise RuntimeError("Unknown command")
+    handler(sys.argv[2:])
+    return 0
 
 
 if __name__ == "__main__":
@@ -5103,3 +6020,6 @@ if __name__ == "__main__":
         if should_alert(key, 300):
             alert_exception("main", full_cmd, e)
         raise
+    finally:
+        flush_samples(force=True)
+        flush_offset(force=True)
@@ -1,8 +1,11 @@
 import os
 import sys
 import tempfile
+import threading
 import types
 import unittest
+import urllib.error
+import urllib.request
 from datetime import date, datetime, timedelta
 from pathlib import Path
 from unittest.mock import patch
@@ -47,6 +50,9 @@ def install_requests_stub_if_needed():
             pass
 
     class Session:
+        def __init__(self):
+            self.headers = {}
+
         def mount(self, *args, **kwargs):
             pass
 
@@ -90,6 +96,8 @@ class CoreTests(unittest.TestCase):
         self.configure_alerts()
 
     def tearDown(self):
+        # 本测试内缓存的采样写回自己的临时目录，不泄漏到后续测试
+        k.flush_samples(force=True)
         for patcher in reversed(self.patchers):
             patcher.stop()
         self.tmp.cleanup()
@@ -101,7 +109,7 @@ class CoreTests(unittest.TestCase):
 
     def point_runtime_paths(self):
         self.patch_attr("DATA_DIR", str(self.tmp_path))
-        self.patch_attr("SAMPLES_PATH", str(self.tmp_path / "samples.json"))
+        self.patch_attr("SAMPLES_PATH", str(self.tmp_path / "samples.jsonl"))
         self.patch_attr("ALERTS_STATE_PATH", str(self.tmp_path / "alerts_state.json"))
         self.patch_attr("HISTORY_PATH", str(self.tmp_path / "history.json"))
         self.patch_attr("REPORT_SCHEDULES_PATH", str(self.tmp_path / "report_schedules.json"))
@@ -109,6 +117,7 @@ class CoreTests(unittest.TestCase):
         self.patch_attr("TG_OFFSET_PATH", str(self.tmp_path / "tg_offset.txt"))
         self.patch_attr("TG_CONFIRM_PATH", str(self.tmp_path / "tg_confirm.json"))
         self.patch_attr("AI_PACK_CACHE_PATH", str(self.tmp_path / "ai_pack_cache.json"))
+        self.patch_attr("_SAMPLES_STATE", {"path": "", "sig": None, "samples": [], "ts": [], "pending": [], "flushed_at": None, "compacted_at": None})
 
     def configure_alerts(self):
         self.patch_attr("ALERTS_ENABLED", True)
@@ -164,6 +173,38 @@ class CoreTests(unittest.TestCase):
         ]
         self.assertEqual(leftovers, [])
 
+    def test_json_state_round_trips_with_and_without_orjson(self):
+        payload = {"days": {"2026-06-01": {"n1": {"name": "东京", "up": 1, "down": 2}}}}
+        for backend in (k.orjson, None):
+            with self.subTest(orjson=backend is not None):
+                self.patch_attr("orjson", backend)
+                target = self.tmp_path / "state.json"
+                k.save_json_atomic(str(target), payload)
+                self.assertIn("东京", target.read_text(encoding="utf-8"))
+                self.assertEqual(k.load_json(str(target), {}), payload)
+                k.save_archive_month("2026-06", payload)
+                self.assertEqual(k.load_archive_month("2026-06"), payload)
+
+    def test_json_dumps_text_is_compact_with_and_without_orjson(self):
+        for backend in (k.orjson, None):
+            with self.subTest(orjson=backend is not None):
+                self.patch_attr("orjson", backend)
+                self.assertEqual(k.json_dumps_text(["东京", "a"]), '["东京","a"]')
+                self.assertEqual(k._json_loads_list(k.json_dumps_text(["x"])), ["x"])
+
+    def test_load_json_cached_reuses_parse_until_file_changes(self):
+        target = str(self.tmp_path / "history.json")
+        self.assertEqual(k.load_json_cached(target, {"days": {}}), {"days": {}})
+
+        k.save_json_atomic(target, {"days": {"2026-06-01": {}}})
+        first = k.load_json_cached(target, {"days": {}})
+        self.assertIs(k.load_json_cached(target, {"days": {}}), first)
+
+        k.save_json_atomic(target, {"days": {"2026-06-02": {}}})
+        second = k.load_json_cached(target, {"days": {}})
+        self.assertIsNot(second, first)
+        self.assertEqual(second, {"days": {"2026-06-02": {}}})
+
     def test_save_archive_month_uses_unique_temp_file(self):
         fixed_tmp = self.tmp_path / "history-2026-06.json.gz.tmp"
         fixed_tmp.write_text("sentinel", encoding="utf-8")
@@ -183,8 +224,11 @@ class CoreTests(unittest.TestCase):
         fixed_tmp = self.tmp_path / "tg_offset.txt.tmp"
         fixed_tmp.write_text("sentinel", encoding="utf-8")
 
-        k.save_offset(12345)
+        synced = []
+        with patch.object(k, "fsync_data", side_effect=synced.append):
+            k.save_offset(12345)
 
+        self.assertEqual(len(synced), 1)
         self.assertEqual(k.load_offset(), 12345)
         self.assertEqual(fixed_tmp.read_text(encoding="utf-8"), "sentinel")
         leftovers = [
@@ -194,6 +238,137 @@ class CoreTests(unittest.TestCase):
         ]
         self.assertEqual(leftovers, [])
 
+    def test_listen_commands_advances_offset_past_failing_update(self):
+        stop_event = threading.Event()
+        polls = []
+        saved = []
+        batches = [
+            {"ok": True, "result": [{"update_id": 9, "message": {"chat": {"id": 42}, "text": "/today"}}]},
+            {"ok": True, "result": []},
+        ]
+
+        def fake_get_updates(offset):
+            polls.append(offset)
+            if len(batches) == 1:
+                stop_event.set()
+            return batches.pop(0)
+
+        def failing_today(chat_id, text, arg_text):
+            raise RuntimeError("report failed")
+
+        self.patch_attr("SHUTDOWN_EVENT", stop_event)
+        self.patch_attr("_TG_OFFSET_STATE", {"pending": None, "saved": None, "flushed_at": None})
+        self.patch_attr("TELEGRAM_BOT_TOKEN", "123:abc")
+        self.patch_attr("TELEGRAM_CHAT_ID", "42")
+        self.patch_attr("_COMMANDS", {"/today": failing_today})
+        self.patch_attr("start_bot_sampling", lambda: None)
+        self.patch_attr("notify_bot_started", lambda: None)
+        self.patch_attr("start_telegram_sender", lambda: None)
+        self.patch_attr("start_report_scheduler", lambda: None)
+        self.patch_attr("stop_sample_worker", lambda: None)
+        self.patch_attr("stop_report_scheduler", lambda: None)
+        self.patch_attr("stop_telegram_sender", lambda: None)
+        self.patch_attr("load_offset", lambda: None)
+        self.patch_attr("get_updates", fake_get_updates)
+        self.patch_attr("save_offset", saved.append)
+        self.patch_attr("should_alert", lambda key, interval=300: False)
+        self.patch_attr("listen_backoff_seconds", lambda attempt: 0)
+
+        k.listen_commands()
+
+        self.assertEqual(polls, [None, 10])
+        self.assertEqual(saved, [10])
+
+    def test_listen_commands_drains_and_flushes_offset_on_shutdown(self):
+        stop_event = threading.Event()
+        events = []
+
+        def fake_get_updates(offset):
+            events.append(("poll", offset))
+            stop_event.set()
+            return {"ok": True, "result": [{"update_id": 9}]}
+
+        self.patch_attr("SHUTDOWN_EVENT", stop_event)
+        self.patch_attr("_TG_OFFSET_STATE", {"pending": None, "saved": None, "flushed_at": 0.0})
+        self.patch_attr("TELEGRAM_BOT_TOKEN", "123:abc")
+        self.patch_attr("TELEGRAM_CHAT_ID", "42")
+        self.patch_attr("start_bot_sampling", lambda: None)
+        self.patch_attr("notify_bot_started", lambda: None)
+        self.patch_attr("start_telegram_sender", lambda: None)
+        self.patch_attr("start_report_scheduler", lambda: None)
+        self.patch_attr("load_offset", lambda: 5)
+        self.patch_attr("get_updates", fake_get_updates)
+        self.patch_attr("save_offset", lambda val: events.append(("save", val)))
+        self.patch_attr("stop_sample_worker", lambda: events.append("stop_sample"))
+        self.patch_attr("stop_report_scheduler", lambda: events.append("stop_scheduler"))
+        self.patch_attr("stop_telegram_sender", lambda: events.append("stop_sender"))
+
+        with patch.object(k.time, "monotonic", lambda: 1.0):
+            k.listen_commands()
+
+        self.assertEqual(
+            events,
+            [("poll", 5), ("save", 10), "stop_sample", "stop_scheduler", "stop_sender"],
+        )
+
+    def test_log_exception_throttled_downgrades_repeats(self):
+        self.patch_attr("_LOG_THROTTLE", {})
+        with self.assertLogs(level="WARNING") as logs:
+            for _ in range(2):
+                try:
+                    raise ValueError("bad config")
+                except ValueError:
+                    k.log_exception_throttled("unit", "reload failed")
+
+        self.assertEqual([record.levelname for record in logs.records], ["ERROR", "WARNING"])
+        self.assertIsNotNone(logs.records[0].exc_info)
+        self.assertIsNone(logs.records[1].exc_info)
+        self.assertIn("bad config", logs.records[1].getMessage())
+
+    def test_listen_backoff_grows_with_full_jitter_and_caps(self):
+        with patch.object(k.random, "uniform", lambda low, high: (low, high)):
+            self.assertEqual(k.listen_backoff_seconds(1), (0, 1.0))
+            self.assertEqual(k.listen_backoff_seconds(3), (0, 4.0))
+            self.assertEqual(k.listen_backoff_seconds(6), (0, 30.0))
+
+    def test_flush_offset_coalesces_writes(self):
+        self.patch_attr("_TG_OFFSET_STATE", {"pending": None, "saved": None, "flushed_at": None})
+        writes = []
+        clock = [100.0]
+        self.patch_attr("save_offset", writes.append)
+
+        with patch.object(k.time, "monotonic", lambda: clock[0]):
+            k.queue_offset(10)
+            k.flush_offset()
+            k.queue_offset(11)
+            k.flush_offset()
+            k.queue_offset(12)
+            k.flush_offset()
+            clock[0] += k.TG_OFFSET_FLUSH_SECONDS
+            k.flush_offset()
+            k.flush_offset()
+            k.queue_offset(13)
+            k.flush_offset(force=True)
+
+        self.assertEqual(writes, [10, 12, 13])
+
+    def test_non_critical_state_files_skip_fsync(self):
+        with patch.object(k, "fsync_data", side_effect=AssertionError("fsync")):
+            self.assertTrue(k.should_alert("unit", 300))
+            self.assertFalse(k.should_alert("unit", 300))
+
+        self.assertGreater(k.load_json(str(self.tmp_path / "alert_unit.json"), {}).get("last", 0), 0)
+
+    def test_durable_writes_sync_data_once_before_replace(self):
+        synced = []
+        with patch.object(k, "fsync_data", side_effect=synced.append):
+            k.save_json_atomic(str(self.tmp_path / "state.json"), {"a": 1})
+            k.save_archive_month("2026-05", {"days": {"2026-05-01": {}}})
+
+        self.assertEqual(len(synced), 2)
+        self.assertEqual(k.load_json(str(self.tmp_path / "state.json"), {}), {"a": 1})
+        self.assertEqual(list(k.load_archive_month("2026-05")["days"]), ["2026-05-01"])
+
     def test_silence_window_supports_cross_midnight(self):
         late = datetime(2026, 6, 6, 23, 30, tzinfo=k.TZ)
         early = datetime(2026, 6, 6, 6, 30, tzinfo=k.TZ)
@@ -213,6 +388,383 @@ class CoreTests(unittest.TestCase):
         self.assertEqual(deltas["u1"]["down"], 0)
         self.assertEqual(warnings, ["node-a(counter_reset)"])
 
+    def test_command_table_routes_top_scope_and_gates_admin(self):
+        calls = []
+        sent = []
+        self.patch_attr("run_period_report", lambda start, end, tag, top_only=False: calls.append((tag, top_only)))
+        self.patch_attr("run_top_last_hours", lambda hours: calls.append(("hours", hours)))
+        self.patch_attr("telegram_send", sent.append)
+        self.patch_attr("is_admin", lambda chat_id: False)
+        self.patch_attr("today_date", lambda: date(2026, 6, 10))
+
+        k._COMMANDS["/top"]("1", "/top 6h", "6h")
+        k._COMMANDS["/top"]("1", "/top week", "week")
+        k._COMMANDS["/top"]("1", "/top nope", "nope")
+        k._COMMANDS["/archive"]("1", "/archive", "")
+
+        self.assertEqual(calls, [("hours", 6), ("WEEK-2026-06-08", True)])
+        self.assertEqual(len(sent), 2)
+        self.assertIn("用法", sent[0])
+        self.assertEqual(sent[1], "⛔ 无权限")
+
+    def test_strict_sample_delta_flags_single_direction_reset(self):
+        current = {
+            "u1": {"name": "node-a", "up": 5, "down": 300},
+            "u2": {"name": "node-b", "up": 50, "down": 60},
+        }
+        previous = {
+            "u1": {"name": "node-a", "up": 100, "down": 200},
+            "u2": {"name": "node-b", "up": 40, "down": 60},
+        }
+
+        deltas, warnings = k.compute_strict_sample_delta_from_maps(current, previous)
+
+        self.assertEqual((deltas["u1"]["up"], deltas["u1"]["down"]), (0, 100))
+        self.assertEqual((deltas["u2"]["up"], deltas["u2"]["down"]), (10, 0))
+        self.assertEqual(warnings, ["node-a(counter_reset)"])
+
+    def test_confirm_archive_runs_in_background_worker(self):
+        sent = []
+        ran = []
+        futures = []
+        notified = threading.Event()
+        submit = k.submit_history_archive
+
+        def record_send(text):
+            sent.append(text)
+            notified.set()
+
+        def record_submit():
+            future = submit()
+            futures.append(future)
+            return future
+
+        self.patch_attr("telegram_send", record_send)
+        self.patch_attr("is_admin", lambda chat_id: True)
+        self.patch_attr("consume_confirm_action", lambda chat_id, action, code: code == "ok")
+        self.patch_attr("archive_and_prune_history", lambda: ran.append(threading.current_thread().name))
+        self.patch_attr("submit_history_archive", record_submit)
+
+        k._COMMANDS["/confirm_archive"]("1", "/confirm_archive ok", "ok")
+        self.assertEqual(len(futures), 1)
+        futures[0].result(timeout=5)
+        # 完成通知由 future 回调发出，回调可能晚于 result() 返回
+        self.assertTrue(notified.wait(5))
+
+        self.assertEqual(len(ran), 1)
+        self.assertTrue(ran[0].startswith("history-archive"))
+        self.assertEqual(sent, ["✅ 已执行历史归档压缩"])
+
+    def test_human_bytes_unit_boundaries(self):
+        self.assertEqual(k.human_bytes(-1), "0 B")
+        self.assertEqual(k.human_bytes(1023), "1023 B")
+        self.assertEqual(k.human_bytes(1024), "1.00 KiB")
+        self.assertEqual(k.human_bytes(1024 ** 2 - 1), "1024.00 KiB")
+        self.assertEqual(k.human_bytes(1024 ** 2), "1.00 MiB")
+        self.assertEqual(k.human_bytes(3 * 1024 ** 3 // 2), "1.50 GiB")
+        self.assertEqual(k.human_bytes(2048 * 1024 ** 5), "2048.00 PiB")
+
+    def test_post_json_reuses_session_and_sends_json_body(self):
+        calls = []
+
+        class FakeResponse:
+            content = b'{"ok": true, "result": {"message_id": 7}}'
+
+            def raise_for_status(self):
+                pass
+
+        class FakeSession:
+            def post(self, url, **kwargs):
+                calls.append((url, kwargs))
+                return FakeResponse()
+
+        session = FakeSession()
+        self.patch_attr("build_post_session", lambda retries=3: session)
+        self.patch_attr("_POST_SESSIONS", {})
+
+        first = k.post_json("https://api.telegram.org/botX/sendMessage", {"chat_id": "1", "text": "东京"})
+        k.post_json("https://api.telegram.org/botX/sendMessage", {"chat_id": "1", "text": "again"})
+
+        self.assertEqual(first["result"]["message_id"], 7)
+        self.assertIs(k.post_session(), session)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0][1]["headers"], {"Content-Type": "application/json"})
+        self.assertEqual(k.json_loads_bytes(calls[0][1]["data"])["text"], "东京")
+
+    def test_telegram_send_waits_retry_after_on_429(self):
+        class RateLimited:
+            status_code = 429
+            headers = {}
+            content = b'{"ok": false, "error_code": 429, "parameters": {"retry_after": 3}}'
+
+        attempts = []
+        sleeps = []
+
+        def fake_post_json(url, payload):
+            attempts.append(payload["chat_id"])
+            if len(attempts) == 1:
+                raise k.requests.exceptions.HTTPError("429", response=RateLimited())
+            return {"ok": True}
+
+        self.patch_attr("TELEGRAM_BOT_TOKEN", "123:abc")
+        self.patch_attr("TELEGRAM_CHAT_ID", "42")
+        self.patch_attr("post_json", fake_post_json)
+        self.patch_attr("_TG_SENT_GLOBAL", k.collections.deque())
+        self.patch_attr("_TG_SENT_BY_CHAT", {})
+        with patch.object(k.time, "sleep", sleeps.append):
+            self.assertEqual(k.telegram_send("hi"), {"ok": True})
+
+        self.assertEqual(attempts, ["42", "42"])
+        self.assertEqual(sleeps, [3.0])
+
+    def test_telegram_reply_batch_merges_replies_per_chat(self):
+        sent = []
+        self.patch_attr("TELEGRAM_BOT_TOKEN", "123:abc")
+        self.patch_attr("TELEGRAM_CHAT_ID", "42")
+        self.patch_attr("TG_MESSAGE_LIMIT", 5)
+        self.patch_attr("post_json", lambda url, payload: sent.append((payload["chat_id"], payload["text"])))
+        self.patch_attr("_TG_SENT_GLOBAL", k.collections.deque())
+        self.patch_attr("_TG_SENT_BY_CHAT", {})
+
+        with k.telegram_reply_batch():
+            k.telegram_send("a")
+            k.telegram_send("b")
+            k.telegram_send_alert("cd")
+            self.assertEqual(sent, [])
+
+        self.assertEqual(sent, [("42", "a\nb"), ("42", "cd")])
+        self.assertEqual(k.split_telegram_text(["12345", "6789", "x" * 12], limit=10), ["12345\n6789", "x" * 10, "xx"])
+
+    def test_telegram_sender_thread_delivers_queued_replies(self):
+        sent = []
+        self.patch_attr("TELEGRAM_BOT_TOKEN", "123:abc")
+        self.patch_attr("TELEGRAM_CHAT_ID", "42")
+        self.patch_attr("_TG_SEND_QUEUE", k.queue.Queue(maxsize=8))
+        self.patch_attr("TG_SEND_THREAD", None)
+        self.patch_attr("post_json", lambda url, payload: sent.append((threading.current_thread().name, payload["text"])))
+        self.patch_attr("_TG_SENT_GLOBAL", k.collections.deque())
+        self.patch_attr("_TG_SENT_BY_CHAT", {})
+
+        k.start_telegram_sender()
+        with k.telegram_reply_batch():
+            k.telegram_send("queued")
+        k.stop_telegram_sender()
+
+        self.assertFalse(k.TG_SEND_THREAD.is_alive())
+        self.assertEqual(sent, [("telegram-sender", "queued")])
+
+    def test_telegram_send_worker_coalesces_per_chat(self):
+        sent = []
+        send_queue = k.queue.Queue()
+        self.patch_attr("TELEGRAM_BOT_TOKEN", "123:abc")
+        self.patch_attr("TELEGRAM_CHAT_ID", "42")
+        self.patch_attr("_TG_SEND_QUEUE", send_queue)
+        self.patch_attr("post_json", lambda url, payload: sent.append((payload["chat_id"], payload["text"])))
+        self.patch_attr("_TG_SENT_GLOBAL", k.collections.deque())
+        self.patch_attr("_TG_SENT_BY_CHAT", {})
+        for item in (("42", "a"), ("7", "b"), ("42", "c"), None):
+            send_queue.put(item)
+
+        k.telegram_send_worker_loop()
+
+        self.assertEqual(sent, [("42", "a\nc"), ("7", "b")])
+
+    def test_telegram_send_worker_alerts_on_failed_reply(self):
+        sent = []
+        alerts = []
+        send_queue = k.queue.Queue()
+
+        def fake_deliver(chat_id, text):
+            if chat_id == "7":
+                raise RuntimeError("403 Forbidden: bot was blocked by the user")
+            sent.append((chat_id, text))
+
+        self.patch_attr("_TG_SEND_QUEUE", send_queue)
+        self.patch_attr("deliver_telegram_reply", fake_deliver)
+        self.patch_attr("alert_exception", lambda where, cmd, exc: alerts.append((where, cmd, str(exc))))
+        for item in (("7", "b"), ("42", "a"), None):
+            send_queue.put(item)
+
+        k.telegram_send_worker_loop()
+        self.assertEqual(sent, [("42", "a")])
+        self.assertEqual(alerts, [("telegram_send_worker", "reply to 7", "403 Forbidden: bot was blocked by the user")])
+
+        # 同一故障在限频窗口内不再重复告警
+        send_queue.put(("7", "c"))
+        send_queue.put(None)
+        k.telegram_send_worker_loop()
+        self.assertEqual(len(alerts), 1)
+
+    def test_telegram_rate_wait_limits_per_chat(self):
+        self.patch_attr("_TG_SENT_GLOBAL", k.collections.deque())
+        self.patch_attr("_TG_SENT_BY_CHAT", {})
+        self.patch_attr("TG_CHAT_PER_MINUTE", 2)
+        clock = [100.0]
+        sleeps = []
+
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            clock[0] += seconds
+
+        with patch.object(k.time, "monotonic", lambda: clock[0]), patch.object(k.time, "sleep", fake_sleep):
+            k.telegram_rate_wait("1")
+            k.telegram_rate_wait("1")
+            k.telegram_rate_wait("2")
+            k.telegram_rate_wait("1")
+
+        self.assertEqual(sleeps, [60.0])
+
+    def test_main_dispatches_subcommand_with_args(self):
+        calls = []
+        self.patch_attr("_CMDS", {"check_alerts": calls.append})
+
+        with patch.object(k.sys, "argv", ["komari_traffic_report.py", "Check_Alerts", "--dry-run"]):
+            self.assertEqual(k.main(), 0)
+        with patch.object(k.sys, "argv", ["komari_traffic_report.py", "nope"]):
+            with self.assertRaises(RuntimeError):
+                k.main()
+
+        self.assertEqual(calls, [["--dry-run"]])
+
+    def test_check_alerts_cli_parses_dry_run_flag(self):
+        calls = []
+        self.patch_attr("validate_config_or_raise", lambda: None)
+        self.patch_attr("run_alert_check", lambda **kwargs: calls.append(kwargs) or {})
+        self.patch_attr("format_alert_check_result", lambda result: "")
+
+        with patch("builtins.print"):
+            k._cli_check_alerts(["--DRY-RUN"])
+        with self.assertRaisesRegex(RuntimeError, "Unknown check_alerts arg"):
+            k._cli_check_alerts(["--force"])
+
+        self.assertEqual(calls, [{"dry_run": True, "notify": False, "force_sample": True}])
+
+    def test_handle_update_dispatches_allowed_commands(self):
+        calls = []
+        self.patch_attr("TELEGRAM_CHAT_ID", "42")
+        self.patch_attr("_COMMANDS", {"/top": lambda chat_id, text, arg: calls.append((chat_id, text, arg))})
+        self.patch_attr("telegram_bot_username", lambda: "my_bot")
+
+        k.handle_update({"update_id": 7, "message": {"chat": {"id": 42}, "text": "/top@my_bot 6h"}})
+        k.handle_update({"message": {"chat": {"id": 42}, "text": "/top@other_bot 6h"}})
+        k.handle_update({"update_id": 8, "message": {"chat": {"id": 99}, "text": "/top"}})
+        k.handle_update({"message": {"chat": {"id": 42}, "text": "hello"}})
+        k.handle_update({"message": {"chat": {"id": 42}, "text": "/top-x"}})
+        k.handle_update({"message": {"chat": {"id": 42}, "text": "/TOP  week extra"}})
+
+        self.assertEqual(calls, [("42", "/top@my_bot 6h", "6h"), ("42", "/TOP  week extra", "week")])
+
+    def test_telegram_bot_username_is_memoized(self):
+        calls = []
+
+        def fake_api_call(method, payload):
+            calls.append(method)
+            return {"ok": True, "result": {"username": "My_Bot"}}
+
+        self.patch_attr("telegram_api_call", fake_api_call)
+        k.telegram_bot_username.cache_clear()
+        self.addCleanup(k.telegram_bot_username.cache_clear)
+
+        self.assertFalse(k.is_command_for_other_bot("my_bot"))
+        self.assertTrue(k.is_command_for_other_bot("other_bot"))
+        self.assertFalse(k.is_command_for_other_bot(None))
+        self.assertEqual(calls, ["getMe"])
+
+    def test_webhook_handler_checks_secret_before_dispatch(self):
+        received = []
+        done = threading.Event()
+
+        def fake_process(upd):
+            received.append(upd)
+            done.set()
+
+        self.patch_attr("TELEGRAM_WEBHOOK_SECRET", "s3cret")
+        self.patch_attr("process_webhook_update", fake_process)
+        server = k.http.server.ThreadingHTTPServer(("127.0.0.1", 0), k.TelegramWebhookHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_address[1]}/"
+
+        def post(secret):
+            req = urllib.request.Request(
+                url,
+                data=b'{"update_id": 1}',
+                headers={"X-Telegram-Bot-Api-Secret-Token": secret, "Content-Type": "application/json"},
+            )
+            try:
+                with urllib.request.urlopen(req, timeout=5) as resp:
+                    return resp.status
+            except urllib.error.HTTPError as e:
+                return e.code
+
+        self.assertEqual(post("wrong"), 403)
+        self.assertEqual(post("s3cret"), 200)
+        # 处理在回 200 之后进行
+        self.assertTrue(done.wait(5))
+        self.assertEqual(received, [{"update_id": 1}])
+
+    def test_help_and_start_reply_with_help_text(self):
+        sent = []
+        self.patch_attr("TELEGRAM_CHAT_ID", "42")
+        self.patch_attr("telegram_send", sent.append)
+
+        k.handle_update({"update_id": 1, "message": {"chat": {"id": 42}, "text": "/help"}})
+        k.handle_update({"update_id": 2, "message": {"chat": {"id": 42}, "text": "/start"}})
+
+        self.assertEqual(sent, [k._HELP_TEXT, k._HELP_TEXT])
+        self.assertIn("/confirm_archive", k._HELP_TEXT)
+
+    def test_parse_top_scope_periods_and_hours(self):
+        self.assertEqual(k.parse_top_scope("/top"), ("today", None))
+        self.assertEqual(k.parse_top_scope("/top W"), ("week", None))
+        self.assertEqual(k.parse_top_scope("/top month"), ("month", None))
+        self.assertEqual(k.parse_top_scope("/top 6H"), ("hours", 6))
+        self.assertEqual(k.parse_top_scope("/top 99999999999h"), ("unknown", None))
+        self.assertEqual(k.parse_top_scope("/top yesterday"), ("unknown", None))
+
+    def test_get_updates_parses_body_and_short_circuits_empty_poll(self):
+        bodies = [b'{"ok":true,"result":[]}', b'{"ok":true,"result":[{"update_id":5}]}']
+
+        class FakeResponse:
+            def __init__(self, content):
+                self.content = content
+
+            def raise_for_status(self):
+                pass
+
+        calls = []
+
+        def fake_get(url, params=None, timeout=None):
+            calls.append((params, timeout))
+            return FakeResponse(bodies.pop(0))
+
+        self.patch_attr("TELEGRAM_BOT_TOKEN", "123:abc")
+        self.patch_attr("telegram_poll_session", lambda: types.SimpleNamespace(get=fake_get))
+        with patch.object(k.requests, "get", side_effect=AssertionError("fresh connection"), create=True):
+            self.assertEqual(k.get_updates(None), {"ok": True, "result": []})
+            self.assertEqual(k.get_updates(5)["result"][0]["update_id"], 5)
+
+        self.assertEqual(calls[0], ({"timeout": 25}, 30))
+        self.assertEqual(calls[1], ({"timeout": 25, "offset": 5}, 30))
+
+    def test_get_updates_retry_backoff_stops_on_shutdown(self):
+        calls = []
+        stop_event = threading.Event()
+
+        def fake_get(url, params=None, timeout=None):
+            calls.append(params)
+            stop_event.set()
+            raise k.requests.exceptions.ConnectionError("reset")
+
+        self.patch_attr("TELEGRAM_BOT_TOKEN", "123:abc")
+        self.patch_attr("SHUTDOWN_EVENT", stop_event)
+        self.patch_attr("telegram_poll_session", lambda: types.SimpleNamespace(get=fake_get))
+        with patch.object(k.time, "sleep", side_effect=AssertionError("uninterruptible sleep")):
+            self.assertEqual(k.get_updates(None), {"ok": True, "result": []})
+        self.assertEqual(len(calls), 1)
+
     def test_top_lines_orders_by_total(self):
         lines = k.top_lines(
             {
@@ -227,6 +779,19 @@ class CoreTests(unittest.TestCase):
         self.assertIn("middle", lines[1])
         self.assertEqual(len(lines), 2)
 
+    def test_top_lines_breaks_ties_like_full_sort(self):
+        deltas = {
+            "a": {"name": "alpha", "up": 5, "down": 5},
+            "b": {"name": "Bravo", "up": 5, "down": 5},
+            "c": {"name": "charlie", "up": 4, "down": 6},
+            "d": {"name": "delta", "up": 1, "down": 1},
+        }
+
+        lines = k.top_lines(deltas, 3)
+
+        self.assertEqual([line.split("</b>")[0].split("<b>")[1] for line in lines], ["charlie", "Bravo", "alpha"])
+        self.assertEqual(k.top_lines(deltas, 0), ["（暂无数据）"])
+
     def test_telegram_reports_escape_dynamic_html(self):
         deltas = {
             "u1": {"name": "node <bad> & edge", "up": 1, "down": 2},
@@ -296,21 +861,17 @@ class CoreTests(unittest.TestCase):
         self.assertNotIn("<tag>", normalized)
 
     def test_node_missing_alert_triggers_and_recovers(self):
-        k.save_samples({
-            "samples": [
-                {"ts": 1000, "nodes": {}, "skipped": ["node-a(timeout)"]},
-            ]
-        })
+        k.save_jsonl_atomic(k.SAMPLES_PATH, [
+            {"ts": 1000, "nodes": {}, "skipped": ["node-a(timeout)"]},
+        ])
         state = k.load_alerts_state()
         first = k.collect_alert_candidates(state, now_ts=1000)
         self.assertEqual(first, [])
 
-        k.save_samples({
-            "samples": [
-                {"ts": 1000, "nodes": {}, "skipped": ["node-a(timeout)"]},
-                {"ts": 1300, "nodes": {}, "skipped": ["node-a(timeout)"]},
-            ]
-        })
+        k.save_jsonl_atomic(k.SAMPLES_PATH, [
+            {"ts": 1000, "nodes": {}, "skipped": ["node-a(timeout)"]},
+            {"ts": 1300, "nodes": {}, "skipped": ["node-a(timeout)"]},
+        ])
         second = k.collect_alert_candidates(state, now_ts=1300)
         self.assertEqual([c["key"] for c in second], ["node_missing:node-a"])
 
@@ -318,22 +879,18 @@ class CoreTests(unittest.TestCase):
         self.assertEqual(events[0]["kind"], "alert")
         self.assertIn("node_missing:node-a", state["active"])
 
-        k.save_samples({
-            "samples": [
-                {"ts": 1600, "nodes": {"u1": {"name": "node-a", "up": 1, "down": 1}}, "skipped": []},
-            ]
-        })
+        k.save_jsonl_atomic(k.SAMPLES_PATH, [
+            {"ts": 1600, "nodes": {"u1": {"name": "node-a", "up": 1, "down": 1}}, "skipped": []},
+        ])
         recovered = k.collect_alert_candidates(state, now_ts=1600)
         events = k.apply_alert_candidates(state, recovered, now_ts=1600)
         self.assertEqual(events[0]["kind"], "recovery")
         self.assertEqual(state["active"], {})
 
     def test_node_missing_does_not_double_count_same_sample(self):
-        k.save_samples({
-            "samples": [
-                {"ts": 1000, "nodes": {}, "skipped": ["node-a(timeout)"]},
-            ]
-        })
+        k.save_jsonl_atomic(k.SAMPLES_PATH, [
+            {"ts": 1000, "nodes": {}, "skipped": ["node-a(timeout)"]},
+        ])
         state = k.load_alerts_state()
 
         self.assertEqual(k.collect_alert_candidates(state, now_ts=1000), [])
@@ -348,12 +905,10 @@ class CoreTests(unittest.TestCase):
         time_patcher.start()
         self.patchers.append(time_patcher)
 
-        k.save_samples({
-            "samples": [
-                {"ts": 1000, "nodes": {"u1": {"name": "node-a", "up": 0, "down": 0}}, "skipped": []},
-                {"ts": 4600, "nodes": {"u1": {"name": "node-a", "up": 50, "down": 100}}, "skipped": []},
-            ]
-        })
+        k.save_jsonl_atomic(k.SAMPLES_PATH, [
+            {"ts": 1000, "nodes": {"u1": {"name": "node-a", "up": 0, "down": 0}}, "skipped": []},
+            {"ts": 4600, "nodes": {"u1": {"name": "node-a", "up": 50, "down": 100}}, "skipped": []},
+        ])
         k.save_traffic_snapshot(1000, {"u1": {"name": "node-a", "up": 0, "down": 0}})
         k.save_traffic_snapshot(4600, {"u1": {"name": "node-a", "up": 50, "down": 100}})
 
@@ -380,6 +935,35 @@ class CoreTests(unittest.TestCase):
         self.assertIsNone(k.normalize_percent_metric(123456789))
         self.assertIsNone(k.normalize_percent_metric({"used": 2, "total": 1}))
 
+    def test_parse_date_accepts_iso_and_unpadded_days(self):
+        self.assertEqual(k.parse_date_yyyy_mm_dd("2026-06-01"), date(2026, 6, 1))
+        self.assertEqual(k.parse_date_yyyy_mm_dd("2026-6-1"), date(2026, 6, 1))
+        with self.assertRaises(ValueError):
+            k.parse_date_yyyy_mm_dd("2026-13-01")
+        for bad in ("2026-W23-1", "20260601", "2026-06-1x"):
+            self.assertFalse(k.is_iso_day_key(bad))
+            with self.assertRaises(ValueError):
+                k.parse_date_yyyy_mm_dd(bad)
+        self.assertEqual(k.yyyymm(date(2026, 6, 30)), "2026-06")
+
+    def test_archive_and_prune_history_compares_iso_day_keys(self):
+        self.patch_attr("today_date", lambda: date(2026, 6, 30))
+        self.patch_attr("HISTORY_HOT_DAYS", 10)
+        self.patch_attr("HISTORY_RETENTION_DAYS", 40)
+        node = {"n1": {"name": "Node One", "up": 1, "down": 2}}
+        k.save_json_atomic(k.HISTORY_PATH, {"days": {
+            "2026-05-01": node,
+            "2026-05-25": node,
+            "2026-06-25": node,
+            "20260626": node,
+            "bad": node,
+        }})
+
+        k.archive_and_prune_history()
+
+        self.assertEqual(list(k.load_json(k.HISTORY_PATH, {})["days"]), ["2026-06-25"])
+        self.assertEqual(list(k.load_archive_month("2026-05")["days"]), ["2026-05-25"])
+
     def test_history_sum_migrates_json_to_sqlite_daily_usage(self):
         k.save_json_atomic(str(self.tmp_path / "history.json"), {
             "days": {
@@ -603,6 +1187,23 @@ class CoreTests(unittest.TestCase):
 
         k.validate_config_or_raise()
 
+    def test_healthcheck_runs_probes_concurrently_and_reports_in_order(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def slow_sqlite():
+            barrier.wait()
+            raise RuntimeError("SQLite healthcheck failed: locked")
+
+        def slow_komari():
+            barrier.wait()
+            raise RuntimeError("Komari unreachable: timeout")
+
+        self.patch_attr("_health_check_sqlite", slow_sqlite)
+        self.patch_attr("_health_check_komari", slow_komari)
+
+        with self.assertRaisesRegex(RuntimeError, "SQLite healthcheck failed"):
+            k.run_healthcheck_or_raise()
+
     def test_traffic_range_summary_aggregates_daily_and_weekly(self):
         k.upsert_daily_usage("2026-06-01", {
             "n1": {"name": "Node One", "up": 10, "down": 20},
@@ -835,12 +1436,61 @@ class CoreTests(unittest.TestCase):
         self.assertEqual([item["total"] for item in total["hours"]], [60, 60])
         self.assertEqual([item["total"] for item in by_node["nodes"][0]["hours"]], [60, 60])
 
+    def test_komari_headers_are_attached_to_session(self):
+        for key, value in k.build_komari_headers().items():
+            self.assertEqual(k.HTTP_SESSION.headers.get(key), value)
+
+    def test_fetch_nodes_reuses_persistent_pool(self):
+        def fake_get_json(url):
+            if url.endswith("/api/nodes"):
+                return {"status": "success", "data": [{"uuid": "n1", "name": "One"}, {"uuid": "n2", "name": "Two"}]}
+            return {"status": "success", "data": [{"network": {"totalUp": 1, "totalDown": 2}}]}
+
+        self.patch_attr("KOMARI_BASE_URL", "https://komari.example")
+        self.patch_attr("get_json", fake_get_json)
+        self.patch_attr("KOMARI_FETCH_WORKERS", 2)
+        self.addCleanup(k.shutdown_fetch_pool)
+
+        current, nodes_map, skipped = k.fetch_nodes_and_totals()
+        pool = k.fetch_pool()
+        k.fetch_nodes_and_totals()
+        self.assertIs(k.fetch_pool(), pool)
+        self.assertEqual(sorted(n.uuid for n in current), ["n1", "n2"])
+        self.assertEqual(nodes_map, {
+            "n1": {"name": "One", "up": 1, "down": 2},
+            "n2": {"name": "Two", "up": 1, "down": 2},
+        })
+        self.assertEqual(skipped, [])
+
+        self.patch_attr("KOMARI_FETCH_WORKERS", 3)
+        self.assertIsNot(k.fetch_pool(), pool)
+        # 其他线程手里的旧池在重建后仍可提交任务
+        self.assertEqual(pool.submit(lambda: 42).result(timeout=5), 42)
+
+    def test_async_fetch_falls_back_without_aiohttp(self):
+        self.patch_attr("KOMARI_FETCH_ASYNC", True)
+        self.patch_attr("aiohttp", None)
+        self.assertFalse(k.komari_async_fetch_available())
+
+        self.patch_attr("KOMARI_FETCH_ASYNC", False)
+        self.assertFalse(k.komari_async_fetch_available())
+
+    def test_parse_recent_node_total_reports_skip_reasons(self):
+        self.assertEqual(k.parse_recent_node_total("n1", "One", {"status": "error"}), (None, "One(bad_resp)"))
+        self.assertEqual(k.parse_recent_node_total("n1", "One", {"status": "success", "data": []}), (None, "One(empty)"))
+        total, skip = k.parse_recent_node_total("n1", "One", {
+            "status": "success",
+            "data": [{"network": {"totalUp": 5, "totalDown": 7}}],
+        })
+        self.assertIsNone(skip)
+        self.assertEqual((total.up, total.down), (5, 7))
+
     def test_take_sample_writes_sqlite_snapshots(self):
         samples = [
-            [k.NodeTotal(uuid="n1", name="Node One", up=10, down=20)],
-            [k.NodeTotal(uuid="n1", name="Node One", up=15, down=35)],
+            ([k.NodeTotal(uuid="n1", name="Node One", up=10, down=20)], {"n1": {"name": "Node One", "up": 10, "down": 20}}, []),
+            ([k.NodeTotal(uuid="n1", name="Node One", up=15, down=35)], {"n1": {"name": "Node One", "up": 15, "down": 35}}, []),
         ]
-        self.patch_attr("fetch_nodes_and_totals", lambda: (samples.pop(0), []))
+        self.patch_attr("fetch_nodes_and_totals", lambda: samples.pop(0))
         with patch.object(k.time, "time", return_value=1000):
             k.take_sample_if_due(force=True, record=False)
         with patch.object(k.time, "time", return_value=1300):
@@ -855,6 +1505,93 @@ class CoreTests(unittest.TestCase):
         self.assertEqual(daily["up"], 5)
         self.assertEqual(daily["down"], 15)
 
+    def test_take_sample_keeps_samples_in_memory_until_flush(self):
+        samples = [
+            ([k.NodeTotal(uuid="n1", name="Node One", up=10, down=20)], {"n1": {"name": "Node One", "up": 10, "down": 20}}, []),
+            ([k.NodeTotal(uuid="n1", name="Node One", up=15, down=35)], {"n1": {"name": "Node One", "up": 15, "down": 35}}, []),
+        ]
+        self.patch_attr("fetch_nodes_and_totals", lambda: samples.pop(0))
+        self.patch_attr("SAMPLE_FLUSH_SECONDS", 3600)
+        with patch.object(k.time, "time", return_value=1000):
+            k.take_sample_if_due(force=True, record=False)
+        with patch.object(k.time, "time", return_value=1300):
+            k.take_sample_if_due(force=True, record=False)
+
+        self.assertEqual([s["ts"] for s in k.load_samples()["samples"]], [1000, 1300])
+        self.assertEqual([s["ts"] for s in k.iter_jsonl(k.SAMPLES_PATH)], [1000])
+
+        self.assertTrue(k.flush_samples(force=True))
+        self.assertFalse(k.flush_samples(force=True))
+        self.assertEqual([s["ts"] for s in k.iter_jsonl(k.SAMPLES_PATH)], [1000, 1300])
+
+    def test_sample_timestamp_index_orders_and_prunes(self):
+        self.patch_attr("SAMPLE_FLUSH_SECONDS", 3600)
+        for ts in (1000, 1600, 1300):
+            k.append_sample({"ts": ts, "nodes": {}, "skipped": []}, 1600)
+
+        self.assertEqual([s["ts"] for s in k.load_samples()["samples"]], [1000, 1300, 1600])
+        self.assertEqual(k.latest_sample()["ts"], 1600)
+
+        k.append_sample({"ts": 1000 + k.SAMPLE_RETENTION_HOURS * 3600 + 301, "nodes": {}, "skipped": []},
+                        1000 + k.SAMPLE_RETENTION_HOURS * 3600 + 301)
+        self.assertEqual([s["ts"] for s in k.load_samples()["samples"]][:1], [1600])
+
+    def test_flush_samples_does_not_reparse_own_writes(self):
+        k.append_sample({"ts": 1000, "nodes": {}, "skipped": []}, 1000)
+        k.flush_samples(force=True)
+        k.append_sample({"ts": 1300, "nodes": {}, "skipped": []}, 1300)
+        k.flush_samples(force=True)
+
+        with patch.object(k, "iter_jsonl", side_effect=AssertionError("reparsed samples.jsonl")):
+            self.assertEqual(k.latest_sample()["ts"], 1300)
+        self.assertEqual([s["ts"] for s in k.iter_jsonl(k.SAMPLES_PATH)], [1000, 1300])
+
+    def test_flush_samples_keeps_samples_appended_by_other_process(self):
+        self.patch_attr("SAMPLE_FLUSH_SECONDS", 3600)
+        k.append_sample({"ts": 1000, "nodes": {}, "skipped": []}, 1000)
+        k.append_sample({"ts": 1010, "nodes": {}, "skipped": []}, 1010)
+        # 另一进程（bot）在本进程有未落盘采样时追加了一条
+        k.append_jsonl(k.SAMPLES_PATH, [{"ts": 1020, "nodes": {}, "skipped": []}])
+        k.append_sample({"ts": 1100, "nodes": {}, "skipped": []}, 1100)
+        self.patch_attr("SAMPLES_COMPACT_INTERVAL_SECONDS", 0)
+        self.assertTrue(k.flush_samples(force=True))
+
+        self.assertEqual([s["ts"] for s in k.iter_jsonl(k.SAMPLES_PATH)], [1000, 1010, 1020, 1100])
+        self.assertEqual([s["ts"] for s in k.load_samples()["samples"]], [1000, 1010, 1020, 1100])
+
+    def test_samples_reload_other_process_writes_while_pending(self):
+        self.patch_attr("SAMPLE_FLUSH_SECONDS", 3600)
+        k.append_sample({"ts": 1000, "nodes": {}, "skipped": []}, 1000)
+        k.append_sample({"ts": 1010, "nodes": {}, "skipped": []}, 1010)
+        k.append_jsonl(k.SAMPLES_PATH, [{"ts": 1020, "nodes": {}, "skipped": []}])
+
+        self.assertEqual([s["ts"] for s in k.load_samples()["samples"]], [1000, 1010, 1020])
+        self.assertEqual([s["ts"] for s in k.iter_jsonl(k.SAMPLES_PATH)], [1000, 1020])
+
+        # 到期后读取即落盘，不依赖采样线程
+        self.patch_attr("SAMPLE_FLUSH_SECONDS", 0)
+        self.assertEqual(k.latest_sample()["ts"], 1020)
+        self.assertEqual(sorted(s["ts"] for s in k.iter_jsonl(k.SAMPLES_PATH)), [1000, 1010, 1020])
+
+    def test_samples_jsonl_appends_and_migrates_legacy_file(self):
+        legacy = self.tmp_path / "samples.json"
+        k.save_json_atomic(str(legacy), {"samples": [{"ts": 1000, "nodes": {}, "skipped": []}]})
+
+        self.assertEqual([s["ts"] for s in k.load_samples()["samples"]], [1000])
+        self.assertFalse(legacy.exists())
+
+        k.append_sample({"ts": 1300, "nodes": {}, "skipped": []}, 1300)
+        k.flush_samples(force=True)
+        with open(k.SAMPLES_PATH, "ab") as f:
+            f.write(b'{"ts": 16')
+
+        self.assertEqual([s["ts"] for s in k.load_samples()["samples"]], [1000, 1300])
+        k.append_sample({"ts": 1600, "nodes": {}, "skipped": []}, 1600)
+        k.flush_samples(force=True)
+        self.assertEqual([s["ts"] for s in k.load_samples()["samples"]], [1000, 1300, 1600])
+        with self.assertRaises(ValueError):
+            list(k.iter_jsonl(k.SAMPLES_PATH, strict=True))
+
     def test_segment_materialization_splits_cross_midnight(self):
         day1 = date(2026, 6, 1)
         day2 = date(2026, 6, 2)
@@ -32,6 +32,7 @@ class WebAppTests(unittest.TestCase):
         self.client = TestClient(w.app)
 
     def tearDown(self):
+        k.flush_samples(force=True)
         for patcher in reversed(self.patchers):
             patcher.stop()
         self.tmp.cleanup()
@@ -48,7 +49,7 @@ class WebAppTests(unittest.TestCase):
 
     def point_runtime_paths(self):
         self.patch_attr(k, "DATA_DIR", str(self.tmp_path))
-        self.patch_attr(k, "SAMPLES_PATH", str(self.tmp_path / "samples.json"))
+        self.patch_attr(k, "SAMPLES_PATH", str(self.tmp_path / "samples.jsonl"))
         self.patch_attr(k, "ALERTS_STATE_PATH", str(self.tmp_path / "alerts_state.json"))
         self.patch_attr(k, "HISTORY_PATH", str(self.tmp_path / "history.json"))
         self.patch_attr(k, "REPORT_SCHEDULES_PATH", str(self.tmp_path / "report_schedules.json"))
@@ -56,6 +57,7 @@ class WebAppTests(unittest.TestCase):
         self.patch_attr(k, "TG_OFFSET_PATH", str(self.tmp_path / "tg_offset.txt"))
         self.patch_attr(k, "TG_CONFIRM_PATH", str(self.tmp_path / "tg_confirm.json"))
         self.patch_attr(k, "AI_PACK_CACHE_PATH", str(self.tmp_path / "ai_pack_cache.json"))
+        self.patch_attr(k, "_SAMPLES_STATE", {"path": "", "sig": None, "samples": [], "ts": [], "pending": [], "flushed_at": None, "compacted_at": None})
 
     def configure_alerts(self):
         self.patch_attr(k, "ALERTS_ENABLED", True)
@@ -94,6 +96,14 @@ class WebAppTests(unittest.TestCase):
         self.assertEqual(response.headers["content-type"].split(";")[0], "application/json")
         self.assertFalse(response.json()["ok"])
 
+    def test_shutdown_flushes_pending_samples(self):
+        self.patch_attr(k, "SAMPLE_FLUSH_SECONDS", 3600)
+        with TestClient(w.app):
+            k.append_sample({"ts": 1000, "nodes": {}, "skipped": []}, 1000)
+            k.append_sample({"ts": 1300, "nodes": {}, "skipped": []}, 1300)
+            self.assertEqual([s["ts"] for s in k.iter_jsonl(k.SAMPLES_PATH)], [1000])
+        self.assertEqual([s["ts"] for s in k.iter_jsonl(k.SAMPLES_PATH)], [1000, 1300])
+
     def test_login_and_session(self):
         self.login()
 
@@ -404,12 +414,10 @@ class WebAppTests(unittest.TestCase):
         self.patch_attr(k, "ALERT_TOTAL_WINDOW_BYTES", 100)
         self.patch_attr(k, "take_sample_if_due", lambda **_kwargs: None)
         self.patch_attr(k.time, "time", lambda: 4600)
-        k.save_samples({
-            "samples": [
-                {"ts": 1000, "nodes": {"u1": {"name": "node-a", "up": 0, "down": 0}}, "skipped": []},
-                {"ts": 4600, "nodes": {"u1": {"name": "node-a", "up": 50, "down": 100}}, "skipped": []},
-            ]
-        })
+        k.save_jsonl_atomic(k.SAMPLES_PATH, [
+            {"ts": 1000, "nodes": {"u1": {"name": "node-a", "up": 0, "down": 0}}, "skipped": []},
+            {"ts": 4600, "nodes": {"u1": {"name": "node-a", "up": 50, "down": 100}}, "skipped": []},
+        ])
         k.save_traffic_snapshot(1000, {"u1": {"name": "node-a", "up": 0, "down": 0}})
         k.save_traffic_snapshot(4600, {"u1": {"name": "node-a", "up": 50, "down": 100}})
 
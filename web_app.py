@@ -11,6 +11,7 @@ import os
 import re
 import secrets
 import time
+from contextlib import asynccontextmanager
 from datetime import date, datetime, timedelta
 from pathlib import Path
 from typing import Any
@@ -43,7 +44,15 @@ WEB_SESSION_SECRET = os.environ.get("WEB_SESSION_SECRET", "").strip() or secrets
 WEB_SESSION_SECRET_TEMPORARY = not bool(os.environ.get("WEB_SESSION_SECRET", "").strip())
 LOGIN_FAILURES: dict[str, dict[str, float | int]] = {}
 
-app = FastAPI(title="Komari Traffic Web", docs_url=None, redoc_url=None)
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    yield
+    # web 进程没有采样线程，退出前把尚未落盘的采样写入 samples.jsonl
+    k.flush_samples(force=True)
+
+
+app = FastAPI(title="Komari Traffic Web", docs_url=None, redoc_url=None, lifespan=lifespan)
 if STATIC_DIR.exists():
     app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
 
@@ -1073,7 +1082,7 @@ def build_system_status_struct(include_recent: bool = True) -> dict:
             "data_dir": str(k.DATA_DIR),
             "files": [
                 file_status(k.HISTORY_PATH, "history.json"),
-                file_status(k.SAMPLES_PATH, "samples.json"),
+                file_status(k.SAMPLES_PATH, "samples.jsonl"),
                 file_status(k.REPORT_SCHEDULES_PATH, "report_schedules.json"),
                 file_status(node_bindings_path(), "node_bindings.json"),
                 file_status(k.AI_PACK_CACHE_PATH, "ai_pack_cache.json"),
@@ -1226,15 +1235,15 @@ def period_parts(scope: str):
     today = k.today_date()
     if scope == "today":
         start = k.start_of_day(today)
-        tag = today.strftime("%Y-%m-%d")
+        tag = today.isoformat()
     elif scope == "week":
         week_start = k.start_of_week(today)
         start = k.start_of_day(week_start)
-        tag = f"WEEK-{week_start.strftime('%Y-%m-%d')}"
+        tag = f"WEEK-{week_start.isoformat()}"
     elif scope == "month":
         month_start = k.start_of_month(today)
         start = k.start_of_day(month_start)
-        tag = f"MONTH-{month_start.strftime('%Y-%m-%d')}"
+        tag = f"MONTH-{month_start.isoformat()}"
     else:
         raise RuntimeError("scope must be today, week, or month")
     return start, now, tag